@@ -0,0 +1,229 @@
+"""
+Offline load test of the full processing graph against a local mock of the OpenAI API.
+
+Synthetic cases are generated, then the suite measures
+    - single-case latency (sequential runs, p50/p95),
+    - throughput with N cases running concurrently,
+    - peak memory (Python allocations and the process's maximum RSS).
+The results are compared with a stored baseline and the script exits with status 1 if a
+metric regressed by more than --tolerance. No network access is needed: the OpenAI endpoints
+are served by benchmarks/mock_openai.py and DuckDuckGo is replaced by a canned stand-in.
+
+Usage:
+    python benchmarks/load_test.py [--cases 4] [--images 8] [--duplicates 1] [--concurrency 4]
+                                   [--latency responses=lognormal:1.5,0.4 ...]
+                                   [--baseline benchmarks/baseline.json] [--save-baseline]
+"""
+
+from mock_openai import MockConfig, start_server, latency_arguments
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import shutil
+import resource
+import tempfile
+import statistics
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LATENCIES = ["files=fixed:0.05", "responses=lognormal:1.0,0.3", "chat=lognormal:0.8,0.3", "embeddings=fixed:0.1", "search=fixed:0.3"]
+
+# Metrics where a higher value is a regression, and where a lower value is one
+LOWER_IS_BETTER = ("latency_p50_seconds", "latency_p95_seconds", "peak_python_memory_mb", "max_rss_mb")
+HIGHER_IS_BETTER = ("throughput_cases_per_minute",)
+
+
+def create_cases(root: str, cases: int, images: int, size: tuple[int, int], seed: int, duplicates: int = 0) -> list[str]:
+    """
+    Create case directories with random noise images.
+
+    Every image has different content, so neither the description cache nor the
+    file registry can hide the work of a case. Each case also gets exact copies of its
+    first image, so every run goes through the merging of near-duplicates in triage.
+
+    Args:
+        root (str): Directory where the cases are created
+        cases (int): Number of cases
+        images (int): Number of images per case
+        size (tuple[int, int]): Width and height of the images
+        seed (int): Seed of the noise, so every run benchmarks the same images
+        duplicates (int, optional): Number of copies of the first image per case. Defaults to 0
+
+    Returns:
+        list[str]: The case directories
+    """
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    case_dirs = []
+    for case in range(cases):
+        case_dir = os.path.join(root, f"case_{case:03d}")
+        os.makedirs(case_dir)
+        for image in range(images):
+            # Low resolution noise scaled up keeps the files realistic in size and cheap to make
+            noise = rng.integers(0, 255, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+            Image.fromarray(noise).resize(size).save(os.path.join(case_dir, f"image_{image:03d}.jpg"), quality=90)
+        for duplicate in range(duplicates if images else 0):
+            shutil.copyfile(os.path.join(case_dir, "image_000.jpg"), os.path.join(case_dir, f"duplicate_{duplicate:03d}.jpg"))
+        case_dirs.append(case_dir)
+    return case_dirs
+
+
+def run_case(case_dir: str, profile: str | None = None) -> float:
+    """
+    Run the processing graph for one case.
+
+    Args:
+        case_dir (str): Directory of the case
+        profile (str | None, optional): Pipeline profile of the run. Defaults to the default profile
+
+    Returns:
+        float: Duration of the run in seconds
+    """
+    from utils.pipeline import create_default_state, get_graph, run_config, delete_checkpoints
+
+    start = time.perf_counter()
+    state = create_default_state(case_dir, profile=profile)
+    get_graph(profile).invoke(state, run_config(state["run_id"]))
+    delete_checkpoints(state["run_id"])
+    return time.perf_counter() - start
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compare the results with a baseline.
+
+    Args:
+        results (dict): Metrics of this run
+        baseline (dict): Metrics of the baseline run
+        tolerance (float): Allowed relative change, e.g. 0.2 for 20%
+
+    Returns:
+        list[str]: Description of every regressed metric
+    """
+    regressions = []
+    for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+        if metric not in baseline or not baseline[metric]:
+            continue
+        change = (results[metric] - baseline[metric]) / baseline[metric]
+        if (metric in LOWER_IS_BETTER and change > tolerance) or (metric in HIGHER_IS_BETTER and change < -tolerance):
+            regressions.append(f"{metric}: {baseline[metric]:.3f} -> {results[metric]:.3f} ({change:+.0%})")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, default=4, help="Number of cases of the throughput test")
+    parser.add_argument("--images", type=int, default=8, help="Number of images per case")
+    parser.add_argument("--duplicates", type=int, default=1, help="Exact copies of the first image per case, merged by triage")
+    parser.add_argument("--image-size", default="3000x2000", help="Size of the generated images")
+    parser.add_argument("--repetitions", type=int, default=3, help="Number of sequential runs of the latency test")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of cases running at the same time in the throughput test")
+    parser.add_argument("--latency", action="append", default=None, help="Latency of a mocked endpoint, e.g. responses=lognormal:1.5,0.4")
+    parser.add_argument("--agent-rounds", type=int, default=3, help="Tool calls of the mocked agent model per run")
+    parser.add_argument("--search-mode", default="online", choices=["online", "cache_only", "offline"], help="SEARCH_MODE of the run, online uses the canned search stand-in")
+    parser.add_argument("--profile", default=None, help="Pipeline profile of the runs (fast, standard or thorough)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=os.path.join(BENCHMARK_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="collateral-bench-")
+    config = MockConfig(latency_arguments(args.latency or DEFAULT_LATENCIES), agent_rounds=args.agent_rounds)
+    server = start_server(config)
+
+    # Everything is configured before the pipeline modules are imported
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ["OPENAI_API_BASE"] = os.environ["OPENAI_BASE_URL"]
+    os.environ["OPENAI_API_KEY"] = "mock"
+    os.environ["LANGSMITH_TRACING"] = "false"
+    os.environ["DESCRIPTION_CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ["SEARCH_CACHE_DIR"] = os.path.join(workdir, "search_cache")
+    os.environ["CHECKPOINT_DB"] = os.path.join(workdir, "checkpoints.sqlite")
+    os.environ["SEARCH_MODE"] = args.search_mode
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "src"))
+
+    import utils.tools
+    from utils.pipeline import warm_up
+
+    class MockSearch:
+        """
+        Stand-in for DuckDuckGoSearchRun with the latency of the "search" endpoint.
+        """
+        def invoke(self, query):
+            config.delay("search")
+            return f"DAF XF 480FT: 12.9 litre PACCAR MX-13 engine, 480 hp (355 kW). Query: {query}"
+
+    utils.tools.DuckDuckGoSearchRun = MockSearch
+
+    width, height = (int(value) for value in args.image_size.split("x"))
+    case_dirs = create_cases(os.path.join(workdir, "cases"), args.repetitions + args.cases, args.images, (width, height), args.seed, args.duplicates)
+    warm_up()
+
+    tracemalloc.start()
+
+    print(f"Latency: {args.repetitions} sequential runs of {args.images} images")
+    latencies = [run_case(case_dir, args.profile) for case_dir in case_dirs[:args.repetitions]]
+
+    print(f"Throughput: {args.cases} cases, {args.concurrency} at a time")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(lambda case_dir: run_case(case_dir, args.profile), case_dirs[args.repetitions:]))
+    wall_seconds = time.perf_counter() - start
+
+    _, peak_python = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+    results = {
+        "latency_p50_seconds": statistics.median(latencies),
+        "latency_p95_seconds": percentile(latencies, 0.95),
+        "throughput_cases_per_minute": args.cases / wall_seconds * 60,
+        "peak_python_memory_mb": peak_python / 1e6,
+        "max_rss_mb": max_rss,
+        "mock_requests": config.requests,
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("baseline", "save_baseline")},
+    }
+    print(json.dumps(results, indent=4))
+    server.shutdown()
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with, store one with --save-baseline.")
+        return 0
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    if baseline.get("parameters") != results["parameters"]:
+        print("[WARNING] The baseline was measured with different parameters.")
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regression compared with {args.baseline} (tolerance {args.tolerance:.0%}).")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+"""
+A local stand-in for the OpenAI endpoints used by the pipeline, for offline benchmarks.
+
+Implements POST /v1/files, DELETE /v1/files/<id>, POST /v1/responses, POST /v1/chat/completions
+(including streaming, structured outputs and tool calls of the ReAct agent) and POST /v1/embeddings.
+Every endpoint answers after a delay drawn from a configurable latency distribution.
+
+Usage as a standalone server:
+    python benchmarks/mock_openai.py --port 8089 --latency responses=lognormal:2,0.4
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=mock python src/app.py
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import re
+import json
+import time
+import uuid
+import base64
+import random
+import struct
+import hashlib
+import argparse
+import threading
+
+ENDPOINTS = ("files", "responses", "chat", "embeddings", "search")
+
+DESCRIPTION_FACTS = [
+    "- **Asset Type:** Vehicle (Tractor unit)",
+    "- **Manufacturer:** DAF",
+    "- **Model:** XF 480FT",
+    "- **Colour:** White cab with grey chassis",
+    "- **Tyres:** Michelin X Line, moderate tread wear",
+    "- **Odometer Reading:** 439,014 km",
+    "- **Cab Interior:** Driver seat shows light wear, dashboard intact",
+    "- **Bodywork:** Minor scratches on the front bumper",
+    "- **Lighting:** Headlights intact",
+    "- **Registration Plate:** Not visible",
+    "- **Engine Bay:** Not visible in this image",
+    "- **Year of Manufacture:** unclear",
+]
+
+REPORT_TEXT = (
+    "- **Asset Type:** Vehicle (Tractor unit)\n- **Manufacturer:** DAF\n- **Model:** XF 480FT\n"
+    "- **General Condition:** Averagely used\n- **Keys:** Not visible"
+)
+
+EMBEDDING_DIMENSIONS = 256
+
+
+def parse_latency(spec: str):
+    """
+    Parse a latency distribution.
+
+    Supported forms: "fixed:S", "uniform:MIN,MAX" and "lognormal:MEDIAN,SIGMA", all in seconds.
+
+    Args:
+        spec (str): The distribution
+
+    Returns:
+        Callable[[], float]: Draws a latency in seconds
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median
+    raise ValueError(f"Unknown latency distribution {spec!r}")
+
+
+class MockConfig:
+    """
+    Latencies and behaviour of the mock server.
+    """
+
+    def __init__(self, latencies: dict | None = None, agent_rounds: int = 3, stream_chunks: int = 40, stream_chunk_delay: float = 0.01):
+        """
+        Args:
+            latencies (dict | None, optional): Latency distribution spec per endpoint (see ENDPOINTS).
+                Missing endpoints answer immediately. Defaults to None
+            agent_rounds (int, optional): Number of tool calls the mocked agent model makes before answering. Defaults to 3
+            stream_chunks (int, optional): Number of pieces of a streamed answer. Defaults to 40
+            stream_chunk_delay (float, optional): Delay between two streamed pieces in seconds. Defaults to 0.01
+        """
+        self.latencies = {endpoint: parse_latency(spec) for endpoint, spec in (latencies or {}).items()}
+        self.agent_rounds = agent_rounds
+        self.stream_chunks = stream_chunks
+        self.stream_chunk_delay = stream_chunk_delay
+        self.requests = {endpoint: 0 for endpoint in ENDPOINTS}
+        self._lock = threading.Lock()
+
+    def delay(self, endpoint: str) -> None:
+        with self._lock:
+            self.requests[endpoint] += 1
+        if endpoint in self.latencies:
+            time.sleep(max(0.0, self.latencies[endpoint]()))
+
+
+def example_from_schema(schema: dict, defs: dict | None = None):
+    """
+    Create a canned value which matches a JSON schema.
+
+    Args:
+        schema (dict): The JSON schema
+        defs (dict | None, optional): The $defs of the root schema. Defaults to None
+
+    Returns:
+        A value of the schema
+    """
+    defs = defs if defs is not None else schema.get("$defs", {})
+    if "$ref" in schema:
+        return example_from_schema(defs[schema["$ref"].split("/")[-1]], defs)
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return example_from_schema(schema[key][0], defs)
+
+    schema_type = schema.get("type", "string")
+    if schema_type == "object":
+        return {name: example_from_schema(prop, defs) for name, prop in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [example_from_schema(schema.get("items", {}), defs)]
+    if schema_type in ("number", "integer"):
+        return 1
+    if schema_type == "boolean":
+        return True
+    return REPORT_TEXT
+
+
+def _usage(prompt: str, completion: str) -> tuple[int, int]:
+    return max(1, len(prompt) // 4), max(1, len(completion) // 4)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    config: MockConfig = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _json(self, payload: dict, status: int = 200) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_DELETE(self):
+        if self.path.startswith("/v1/files/"):
+            self.config.delay("files")
+            return self._json({"id": self.path.rsplit("/", 1)[-1], "object": "file", "deleted": True})
+        self._json({"error": {"message": "Not found"}}, 404)
+
+    def do_POST(self):
+        body = self._body()
+        if self.path == "/v1/files":
+            self.config.delay("files")
+            return self._json({
+                "id": f"file-{uuid.uuid4().hex}", "object": "file", "bytes": len(body), "created_at": int(time.time()),
+                "filename": "image.jpg", "purpose": "vision", "status": "processed",
+            })
+
+        request = json.loads(body or b"{}")
+        if self.path == "/v1/responses":
+            self.config.delay("responses")
+            return self._json(self._response(request))
+        if self.path == "/v1/embeddings":
+            self.config.delay("embeddings")
+            return self._json(self._embeddings(request))
+        if self.path == "/v1/chat/completions":
+            self.config.delay("chat")
+            if request.get("stream"):
+                return self._stream_chat(request)
+            return self._json(self._chat(request))
+        self._json({"error": {"message": "Not found"}}, 404)
+
+    def _response(self, request: dict) -> dict:
+        prompt = json.dumps(request.get("input"))
+        # Each image gets a stable subset of the facts, so repeated facts appear across images
+        rng = random.Random(prompt)
+        if request.get("text", {}).get("format", {}).get("name") == "image_region":
+            # A stable region of about a quarter of the image, so the crops of find_information are exercised
+            left, top = round(rng.uniform(0, 0.5), 2), round(rng.uniform(0, 0.5), 2)
+            text = json.dumps({"found": True, "box": [left, top, left + 0.4, top + 0.4]})
+        else:
+            text = "\n".join(rng.sample(DESCRIPTION_FACTS, k=6))
+        input_tokens, output_tokens = _usage(prompt, text)
+        return {
+            "id": f"resp_{uuid.uuid4().hex}", "object": "response", "created_at": int(time.time()), "status": "completed",
+            "model": request.get("model"), "error": None, "incomplete_details": None, "instructions": None, "metadata": {},
+            "parallel_tool_calls": True, "temperature": 1.0, "top_p": 1.0, "tool_choice": "auto", "tools": [],
+            "output": [{
+                "type": "message", "id": f"msg_{uuid.uuid4().hex}", "status": "completed", "role": "assistant",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "usage": {
+                "input_tokens": input_tokens + 1000, "output_tokens": output_tokens, "total_tokens": input_tokens + 1000 + output_tokens,
+                "input_tokens_details": {"cached_tokens": 0}, "output_tokens_details": {"reasoning_tokens": 0},
+            },
+        }
+
+    def _embeddings(self, request: dict) -> dict:
+        texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        data = []
+        for index, text in enumerate(texts):
+            rng = random.Random(hashlib.sha256(str(text).encode()).digest())
+            vector = [rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode()
+            else:
+                embedding = vector
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(str(text)) // 4 for text in texts)
+        return {"object": "list", "data": data, "model": request.get("model"), "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    def _chat_message(self, request: dict) -> tuple[dict, str]:
+        """
+        Decide the assistant message of a chat completion and its finish reason.
+        """
+        messages = request.get("messages", [])
+        tools = {tool["function"]["name"]: tool["function"] for tool in request.get("tools", [])}
+        tool_choice = request.get("tool_choice")
+
+        # Structured output through a forced function call
+        if isinstance(tool_choice, dict) and tool_choice.get("function", {}).get("name") in tools:
+            function = tools[tool_choice["function"]["name"]]
+            return self._tool_call(function["name"], example_from_schema(function.get("parameters", {}))), "tool_calls"
+
+        # Structured output through a JSON schema response format
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            content = json.dumps(example_from_schema(response_format["json_schema"]["schema"]))
+            return {"role": "assistant", "content": content}, "stop"
+
+        # The ReAct agent: select images, analyze them, search the web, then answer
+        tool_results = [message for message in messages if message.get("role") == "tool"]
+        if tools and len(tool_results) < self.config.agent_rounds:
+            round_tools = [name for name in ("select_relevant_images", "analyze_images", "ddg_search") if name in tools]
+            name = round_tools[len(tool_results) % len(round_tools)]
+            if name == "select_relevant_images":
+                arguments = {"missing_info_summary": "Year of manufacture and registration plate"}
+            elif name == "analyze_images":
+                paths = re.findall(r"[\w./\\-]+\.(?:jpg|jpeg|png|webp)", tool_results[-1].get("content", "") if tool_results else "")
+                arguments = {"image_paths": paths[:3], "information": "Year of manufacture and registration plate"}
+            else:
+                arguments = {"query": "DAF XF 480FT engine power"}
+            return self._tool_call(name, arguments), "tool_calls"
+
+        return {"role": "assistant", "content": REPORT_TEXT}, "stop"
+
+    def _tool_call(self, name: str, arguments: dict) -> dict:
+        return {
+            "role": "assistant", "content": None,
+            "tool_calls": [{"id": f"call_{uuid.uuid4().hex[:24]}", "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}],
+        }
+
+    def _chat(self, request: dict) -> dict:
+        message, finish_reason = self._chat_message(request)
+        prompt_tokens, completion_tokens = _usage(json.dumps(request.get("messages")), json.dumps(message))
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": request.get("model"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+            "usage": {
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        }
+
+    def _stream_chat(self, request: dict) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(payload) -> None:
+            data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode()
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model")}
+        text = REPORT_TEXT
+        size = max(1, len(text) // self.config.stream_chunks)
+        for start in range(0, len(text), size):
+            send({**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": text[start:start + size]}, "finish_reason": None}]})
+            time.sleep(self.config.stream_chunk_delay)
+        send({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+
+        if (request.get("stream_options") or {}).get("include_usage"):
+            prompt_tokens, completion_tokens = _usage(json.dumps(request.get("messages")), text)
+            send({**base, "choices": [], "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}})
+        send("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def start_server(config: MockConfig, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Start the mock server in a background thread.
+
+    Args:
+        config (MockConfig): Latencies and behaviour of the server
+        port (int, optional): Port to listen on, 0 picks a free one. Defaults to 0
+
+    Returns:
+        ThreadingHTTPServer: The running server, its base URL is http://127.0.0.1:<server_port>/v1
+    """
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def latency_arguments(values: list[str]) -> dict:
+    """
+    Parse "endpoint=distribution" command line values.
+    """
+    latencies = {}
+    for value in values:
+        endpoint, _, spec = value.partition("=")
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"Unknown endpoint {endpoint!r}, use one of {', '.join(ENDPOINTS)}")
+        parse_latency(spec)
+        latencies[endpoint] = spec
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", action="append", default=[], help="Latency of an endpoint, e.g. responses=lognormal:2,0.4")
+    parser.add_argument("--agent-rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    server = start_server(MockConfig(latency_arguments(args.latency), agent_rounds=args.agent_rounds), args.port)
+    print(f"Mock OpenAI API listening on http://127.0.0.1:{server.server_port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,69 +1,48 @@
 from pprint import pprint
-from langgraph.graph import StateGraph, START, END
-from utils.helpers import ImageProcessingState, load_images, describe_images, aggregate_info, finish_report
+from utils.pipeline import create_default_state, get_graph, warm_up, run_config, delete_checkpoints
+from utils.jobs import job_manager, JobQueueFullError
+from utils.helpers import IMAGE_EXTENSIONS
+from utils.cases import is_valid_case_id
+from utils.profiles import PROFILES, DEFAULT_PROFILE
+from utils.scheduler import PRIORITY_INTERACTIVE, PRIORITY_BATCH
 from dotenv import load_dotenv
-from utils.agent import RefiningAgent
 
 import os
-from flask import Flask, request, jsonify
+import json
+import shutil
+import tempfile
+from flask import Flask, request, jsonify, Response, stream_with_context, url_for
+from werkzeug.utils import secure_filename
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 app = Flask(__name__)
 
 load_dotenv()
 
-def create_default_state(images_dir: str) -> ImageProcessingState:
-    """
-    Create a default ImageProcessingState with initial values.
-
-    Args:
-        images_dir (str): The directory containing the images.
-
-    Returns:
-        ImageProcessingState: A state object with default values.
-    """
-    return {
-        "images_dir": images_dir,
-        "images": [],
-        "image_names": [],
-        "image_paths": [],
-        "features": [],
-        "aggregated_info": "",
-        "final_report_markdown": "",
-        "messages": []
-    }
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(os.getcwd(), "temp_uploads"))
+PRIORITIES = {"interactive": PRIORITY_INTERACTIVE, "batch": PRIORITY_BATCH}
 
 @app.route("/process_images", methods=["POST"])
 def process_images():
     data = request.json
     images_dir = data.get("images_dir")
+    case_id = data.get("case_id")
+    profile = data.get("profile", DEFAULT_PROFILE)
 
     if not images_dir or not os.path.exists(images_dir):
         return jsonify({"error": "Invalid image directory"}), 400
+    if case_id is not None and not is_valid_case_id(case_id):
+        return jsonify({"error": "Invalid case ID"}), 400
+    if profile not in PROFILES:
+        return jsonify({"error": f"Invalid profile, use one of {', '.join(PROFILES)}"}), 400
 
-    graph_builder = StateGraph(ImageProcessingState)
-
-    # Define the basic data processing nodes
-    graph_builder.add_node("load_images", load_images)
-    graph_builder.add_node("extract_text_vision_model", describe_images)
-    graph_builder.add_node("aggregate_info", aggregate_info)
-    graph_builder.add_node("refine_agent", RefiningAgent())
-    graph_builder.add_node("finish_report", finish_report)
-    
-    # Define the main flow
-    graph_builder.add_edge(START, "load_images")
-    graph_builder.add_edge("load_images", "extract_text_vision_model")
-    graph_builder.add_edge("extract_text_vision_model", "aggregate_info")
-    graph_builder.add_edge("aggregate_info", "refine_agent")
-    graph_builder.add_edge("refine_agent", "finish_report")
-    graph_builder.add_edge("finish_report", END)
-    
-    
-    # Compile the graph
-    graph = graph_builder.compile()
-
-    state = create_default_state(images_dir)
-    
-    final_state = graph.invoke(state)
+    state = create_default_state(images_dir, case_id=case_id, profile=profile)
+
+    try:
+        final_state = get_graph(profile).invoke(state, run_config(state["run_id"]))
+    finally:
+        # A synchronous run cannot be retried, its checkpoints are never needed again
+        delete_checkpoints(state["run_id"])
 
     print("Final report:")
     pprint(final_state["final_report_markdown"])
@@ -71,5 +50,152 @@ def process_images():
     return jsonify({"report": final_state["final_report_markdown"]}), 200
 
 
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """
+    Queue a report generation job and return its ID immediately.
+
+    The images are either uploaded as multipart form data (field "images") or referenced
+    by a directory path in a JSON body ({"images_dir": ...}). Uploaded images are written
+    to a staging directory of their own, which is removed when the job is done. The optional
+    "priority" field ("interactive" or "batch") decides which job's LLM requests go first
+    when the rate limits are reached. With the optional "case_id" field, only the new or changed
+    images of an earlier submitted case are described again. The optional "profile" field
+    ("fast", "standard" or "thorough") chooses the models and stages of the pipeline.
+    """
+    fields = request.form if request.files else request.json
+    priority_name = fields.get("priority", "interactive")
+    if priority_name not in PRIORITIES:
+        return jsonify({"error": f"Invalid priority, use one of {', '.join(PRIORITIES)}"}), 400
+    case_id = fields.get("case_id") or None
+    profile = fields.get("profile") or DEFAULT_PROFILE
+    if profile not in PROFILES:
+        return jsonify({"error": f"Invalid profile, use one of {', '.join(PROFILES)}"}), 400
+    if case_id is not None and not is_valid_case_id(case_id):
+        return jsonify({"error": "Invalid case ID, use 1 to 64 letters, digits, underscores or dashes"}), 400
+
+    staging_dir = None
+    if request.files:
+        staging_dir = stage_uploads(request.files.getlist("images"))
+        if staging_dir is None:
+            return jsonify({"error": "No valid images were uploaded"}), 400
+        images_dir = staging_dir
+    else:
+        data = request.json
+        images_dir = data.get("images_dir")
+
+        if not images_dir or not os.path.exists(images_dir):
+            return jsonify({"error": "Invalid image directory"}), 400
+
+    on_done = (lambda: shutil.rmtree(staging_dir, ignore_errors=True)) if staging_dir else None
+    try:
+        job = job_manager.submit(create_default_state(images_dir, case_id=case_id, profile=profile), on_done=on_done, priority=PRIORITIES[priority_name])
+    except JobQueueFullError as e:
+        if on_done is not None:
+            on_done()
+        return jsonify({"error": str(e)}), 429
+
+    return jsonify({
+        "job_id": job.id,
+        "status_url": url_for("job_status", job_id=job.id),
+        "events_url": url_for("job_events", job_id=job.id),
+    }), 202
+
+
+def stage_uploads(files) -> str | None:
+    """
+    Write uploaded images to a new, unique staging directory without decoding them.
+
+    Args:
+        files (list[FileStorage]): The uploaded files
+
+    Returns:
+        str | None: Path of the staging directory, or None if none of the files is an image
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=UPLOAD_DIR)
+
+    saved = 0
+    for i, file in enumerate(files):
+        filename = secure_filename(file.filename or "")
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        # The index keeps uploads with the same name apart
+        file.save(os.path.join(staging_dir, f"{i:04d}_{filename}"))
+        saved += 1
+
+    if saved == 0:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return None
+    return staging_dir
+
+
+@app.route("/jobs/<job_id>/retry", methods=["POST"])
+def retry_job(job_id):
+    """
+    Resume a failed job from the last pipeline stage it completed, as a new job.
+
+    The optional "priority" field of the JSON body works like the one of POST /jobs.
+    """
+    priority_name = (request.get_json(silent=True) or {}).get("priority", "interactive")
+    if priority_name not in PRIORITIES:
+        return jsonify({"error": f"Invalid priority, use one of {', '.join(PRIORITIES)}"}), 400
+
+    try:
+        job = job_manager.retry(job_id, priority=PRIORITIES[priority_name])
+    except KeyError:
+        return jsonify({"error": "Unknown job"}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+    except JobQueueFullError as e:
+        return jsonify({"error": str(e)}), 429
+
+    return jsonify({
+        "job_id": job.id,
+        "status_url": url_for("job_status", job_id=job.id),
+        "events_url": url_for("job_events", job_id=job.id),
+    }), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    Return the status of a job, and its report once it is finished.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    return jsonify(job.to_dict()), 200
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """
+    Stream the progress events of a job as Server-Sent Events until the job is done.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    def generate():
+        for event in job_manager.events(job):
+            if event is None:
+                yield ": heartbeat\n\n"
+            else:
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Expose the pipeline metrics in the Prometheus text format.
+    """
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    warm_up()
+    app.run(host='0.0.0.0', port=5001, debug=True, threaded=True)
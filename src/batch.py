@@ -0,0 +1,198 @@
+"""
+Generates reports for many archived cases offline.
+
+Every directory below the input directory which contains images is a case. The cases are
+run through the processing graph in parallel, at most --concurrency at a time. The report of
+a case is written to <output>/<case>/report.md; cases which already have a report are skipped,
+so an interrupted batch continues where it stopped. A case which failed is resumed from the last
+pipeline stage it completed, unless --restart is given. The intermediate results of every case are
+kept in the case store, so a case rerun with --force only describes its new or changed images. A throughput summary is written to
+<output>/summary.json.
+
+Usage:
+    python src/batch.py <cases_dir> [--output data/batch] [--concurrency 4] [--force] [--restart] [--profile standard]
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.pipeline import create_default_state, get_graph, warm_up, run_config, can_resume, run_profile, delete_checkpoints
+from utils.profiles import PROFILES, DEFAULT_PROFILE
+from utils.helpers import IMAGE_EXTENSIONS
+from utils.scheduler import llm_priority, PRIORITY_BATCH
+from utils.cache import content_hash
+
+import os
+import re
+import json
+import time
+import argparse
+import statistics
+import traceback
+
+
+def find_cases(cases_dir: str) -> list[str]:
+    """
+    Find the case directories, i.e. the directories which directly contain images.
+
+    Args:
+        cases_dir (str): Root of the case tree
+
+    Returns:
+        list[str]: Paths of the case directories, relative to cases_dir
+    """
+    cases = []
+    for dirpath, dirnames, filenames in os.walk(cases_dir):
+        dirnames.sort()
+        if any(filename.lower().endswith(IMAGE_EXTENSIONS) for filename in filenames):
+            cases.append(os.path.relpath(dirpath, cases_dir))
+    return cases
+
+
+def write_atomic(path: str, content: str) -> None:
+    """
+    Write a file so that it either has the complete content or does not exist.
+
+    Args:
+        path (str): Path of the file
+        content (str): Content to write
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def case_id_of(case: str) -> str:
+    """
+    Derive the case store ID of a case from its path.
+
+    The readable part alone is not unique ("2023/case 1" and "2023_case_1" both become
+    "2023_case_1"), so a hash of the path is appended. Cases with the same ID would share their
+    case store record and their checkpoints.
+
+    Args:
+        case (str): Path of the case directory, relative to cases_dir
+
+    Returns:
+        str: The path with every other character than letters, digits, "_" and "-" replaced by "_",
+             shortened if needed, followed by "-" and the first 8 hex digits of a hash of the path
+    """
+    readable = re.sub(r"[^A-Za-z0-9_\-]", "_", case)[:55]
+    return f"{readable}-{content_hash(case.replace(os.sep, '/'))[:8]}"
+
+
+def process_case(cases_dir: str, case: str, output_dir: str, restart: bool = False, profile: str | None = None) -> dict:
+    """
+    Run the processing graph for a single case and write its report.
+
+    The run ID is derived from the case, so a failed run of the case is found again and
+    resumed from its last checkpoint.
+
+    Args:
+        cases_dir (str): Root of the case tree
+        case (str): Path of the case directory, relative to cases_dir
+        output_dir (str): Root of the output tree
+        restart (bool, optional): Start a failed case from the beginning. Defaults to False
+        profile (str | None, optional): The pipeline profile of new runs. Defaults to DEFAULT_PROFILE
+
+    Returns:
+        dict: The case, whether it succeeded, its number of images and its duration
+    """
+    case_output_dir = os.path.join(output_dir, case)
+    os.makedirs(case_output_dir, exist_ok=True)
+    error_path = os.path.join(case_output_dir, "error.txt")
+
+    start = time.perf_counter()
+    try:
+        run_id = f"batch-{case_id_of(case)}"
+        state = None
+        if restart or not can_resume(run_id):
+            state = create_default_state(os.path.join(cases_dir, case), run_id=run_id, case_id=case_id_of(case), profile=profile)
+        else:
+            # A resumed run keeps the profile it was started with
+            profile = run_profile(run_id)
+            print(f"Resuming {case} from its last checkpoint")
+        with llm_priority(PRIORITY_BATCH):
+            final_state = get_graph(profile).invoke(state, run_config(run_id))
+        delete_checkpoints(run_id)
+        write_atomic(os.path.join(case_output_dir, "report.md"), final_state["final_report_markdown"])
+        if os.path.exists(error_path):
+            os.remove(error_path)
+        return {"case": case, "ok": True, "images": len(final_state["image_paths"]), "seconds": time.perf_counter() - start}
+    except Exception:
+        write_atomic(error_path, traceback.format_exc())
+        return {"case": case, "ok": False, "images": 0, "seconds": time.perf_counter() - start}
+
+
+def run_batch(cases_dir: str, output_dir: str, concurrency: int, force: bool = False, restart: bool = False, profile: str | None = None) -> dict:
+    """
+    Process every case of a case tree which has no report yet.
+
+    Args:
+        cases_dir (str): Root of the case tree
+        output_dir (str): Root of the output tree
+        concurrency (int): Maximum number of cases processed at the same time
+        force (bool, optional): Process cases which already have a report as well. Defaults to False
+        restart (bool, optional): Start failed cases from the beginning instead of resuming them. Defaults to False
+        profile (str | None, optional): The pipeline profile of the cases. Defaults to DEFAULT_PROFILE
+
+    Returns:
+        dict: The throughput summary of the batch
+
+    Raises:
+        ValueError: If two cases have the same case ID
+    """
+    cases = find_cases(cases_dir)
+    # Two cases with one ID would share their case store record and checkpoints
+    case_ids = {}
+    for case in cases:
+        other = case_ids.setdefault(case_id_of(case), case)
+        if other != case:
+            raise ValueError(f"The cases {other!r} and {case!r} have the same case ID {case_id_of(case)!r}")
+    pending = [case for case in cases if force or not os.path.exists(os.path.join(output_dir, case, "report.md"))]
+    print(f"Found {len(cases)} cases, {len(cases) - len(pending)} already have a report.")
+
+    warm_up()
+    results = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(process_case, cases_dir, case, output_dir, restart, profile) for case in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"[{len(results)}/{len(pending)}] {result['case']}: {'done' if result['ok'] else 'FAILED'} in {result['seconds']:.1f} s")
+    wall_seconds = time.perf_counter() - start
+
+    succeeded = [result for result in results if result["ok"]]
+    durations = sorted(result["seconds"] for result in succeeded)
+    summary = {
+        "cases_found": len(cases),
+        "cases_skipped": len(cases) - len(pending),
+        "cases_processed": len(succeeded),
+        "cases_failed": [result["case"] for result in results if not result["ok"]],
+        "images_processed": sum(result["images"] for result in succeeded),
+        "concurrency": concurrency,
+        "profile": profile or DEFAULT_PROFILE,
+        "wall_seconds": wall_seconds,
+        "cases_per_hour": len(succeeded) / wall_seconds * 3600 if wall_seconds else 0.0,
+        "images_per_minute": sum(result["images"] for result in succeeded) / wall_seconds * 60 if wall_seconds else 0.0,
+        "case_seconds_p50": statistics.median(durations) if durations else None,
+        "case_seconds_max": durations[-1] if durations else None,
+    }
+
+    os.makedirs(output_dir, exist_ok=True)
+    write_atomic(os.path.join(output_dir, "summary.json"), json.dumps(summary, indent=4))
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cases_dir", help="Directory containing the case directories")
+    parser.add_argument("--output", default=os.path.join("data", "batch"), help="Directory where the reports are written")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of cases processed at the same time")
+    parser.add_argument("--force", action="store_true", help="Process cases which already have a report as well")
+    parser.add_argument("--restart", action="store_true", help="Start failed cases from the beginning instead of resuming them")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, choices=list(PROFILES), help="Pipeline profile of the cases")
+    args = parser.parse_args()
+
+    summary = run_batch(args.cases_dir, args.output, args.concurrency, args.force, args.restart, args.profile)
+    print(json.dumps(summary, indent=4))
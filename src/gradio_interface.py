@@ -1,77 +1,148 @@
 import gradio as gr
 import requests
 import os
-from PIL import Image
+import json
+import mimetypes
+from contextlib import ExitStack
+from utils.profiles import PROFILES, DEFAULT_PROFILE
 
-def process_images(images):
+BACKEND_URL = os.getenv("BACKEND_URL", "http://backend:5001")
+# Timeout of connecting and of single requests (including the upload), in seconds
+REQUEST_TIMEOUT = 120
+# Maximum silence on the event stream; the backend sends a heartbeat every 15 seconds
+EVENT_TIMEOUT = 60
+
+STAGE_NAMES = {
+    "load_images": "Loading images",
+    "preprocess_images": "Sorting out duplicates and preprocessing images",
+    "extract_text_vision_model": "Describing images",
+    "merge_features": "Merging descriptions",
+    "aggregate_info": "Drafting the report",
+    "write_report": "Writing the report",
+    "check_completeness": "Checking the report for missing information",
+    "refine_agent": "Refining the report",
+    "finish_report": "Finishing the report",
+}
+
+def process_images(images, case_id, profile):
     # First, return an immediate "In progress" message
     yield "Processing your images... Please wait."
     
-    # Create a temporary directory to store uploaded images
-    temp_dir = "./temp_uploads"
-    os.makedirs(temp_dir, exist_ok=True)
-    
     # Check if images is a list (multiple images) or a single image
     if not isinstance(images, list):
         images = [images]
     
-    # Save uploaded images to the temp directory
+    # Collect the paths of the uploaded images
     image_paths = []
-    for i, img_tuple in enumerate(images):
+    for img_tuple in images:
         # Gallery component returns a tuple with the image path as the first element
         img_path = img_tuple
         if isinstance(img_tuple, tuple):
             img_path = img_tuple[0]  # Extract the image path from the tuple
             
-        # Generate a new path in the temp directory
-        new_path = os.path.join(temp_dir, f"image_{i}.jpg")
-        
-        # Copy the image to the temp directory
         if os.path.exists(img_path):
-            img = Image.open(img_path)
-            img.save(new_path)
-            image_paths.append(new_path)
+            image_paths.append(img_path)
     
     if not image_paths:
         yield "No valid images were uploaded."
         return
     
     try:
-        yield "Images uploaded. Waiting for AI to create report. This may take a few minutes..."
-        
-        # Send the directory path to your Flask endpoint
-        response = requests.post(
-            "http://backend:5001/process_images",
-            json={"images_dir": temp_dir}
-        )
+        yield "Uploading images. Waiting for AI to create report. This may take a few minutes..."
         
-        # Print debug information
-        print(f"Status code: {response.status_code}")
-        print(f"Response text: {response.text}")
-        
-        # Clean up temporary files after processing
-        for path in image_paths:
-            if os.path.exists(path):
-                os.remove(path)
-        
-        # Check if response is valid JSON
-        if response.status_code == 200:
-            try:
-                result = response.json()["report"]
-                yield result
-            except Exception as json_err:
-                yield f"Error parsing JSON response: {str(json_err)}\nResponse text: {response.text[:500]}"
-        else:
+        # Upload the image files as they are to your Flask endpoint
+        with ExitStack() as stack:
+            files = [
+                ("images", (os.path.basename(path), stack.enter_context(open(path, "rb")), mimetypes.guess_type(path)[0] or "application/octet-stream"))
+                for path in image_paths
+            ]
+            response = requests.post(
+                f"{BACKEND_URL}/jobs",
+                files=files,
+                data={"profile": profile, **({"case_id": case_id.strip()} if case_id and case_id.strip() else {})},
+                timeout=REQUEST_TIMEOUT
+            )
+
+        if response.status_code != 202:
             yield f"Server error: {response.status_code} - {response.text}"
+            return
+
+        job = response.json()
+        finished_nodes = []
+        report_tokens = []
+        for event_type, event in read_events(f"{BACKEND_URL}{job['events_url']}"):
+            if event_type == "token":
+                # The final report is shown while it is being written
+                report_tokens.append(event["text"])
+                yield "".join(report_tokens)
+            elif event_type == "node_started":
+                yield format_progress(finished_nodes, event["node"])
+            elif event_type == "node_finished":
+                finished_nodes.append(event["node"])
+                yield format_progress(finished_nodes, None)
+            elif event_type == "job_finished":
+                yield event["report"]
+                return
+            elif event_type == "job_failed":
+                yield f"Error processing images: {event['error']}"
+                return
+
+        yield "The connection to the server was closed before the report was finished."
     except Exception as e:
         yield f"Error processing images: {str(e)}"
 
+def read_events(url):
+    """
+    Read a Server-Sent Events stream.
+
+    Args:
+        url (str): URL of the event stream
+
+    Yields:
+        tuple[str, dict]: The type and the data of each event
+    """
+    with requests.get(url, stream=True, timeout=(REQUEST_TIMEOUT, EVENT_TIMEOUT)) as response:
+        response.raise_for_status()
+        event_type, data = None, []
+        for line in response.iter_lines(decode_unicode=True):
+            if line is None:
+                continue
+            if line == "":
+                if event_type is not None:
+                    yield event_type, json.loads("\n".join(data))
+                event_type, data = None, []
+            elif line.startswith("event:"):
+                event_type = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data.append(line[len("data:"):].strip())
+
+def format_progress(finished_nodes, running_node):
+    """
+    Format the progress of a job as markdown.
+
+    Args:
+        finished_nodes (list[str]): Names of the finished pipeline stages
+        running_node (str | None): Name of the running stage
+
+    Returns:
+        str: The progress message
+    """
+    lines = ["Creating the report... This may take a few minutes.", ""]
+    lines += [f"- ✅ {STAGE_NAMES.get(node, node)}" for node in finished_nodes]
+    if running_node is not None:
+        lines.append(f"- ⏳ {STAGE_NAMES.get(running_node, running_node)}")
+    return "\n".join(lines)
+
 # Create Gradio interface
 with gr.Blocks() as demo:
     gr.Markdown("# Image Processing Tool")
     
     with gr.Row():
         image_input = gr.Gallery(label="Upload Images")
+
+    with gr.Row():
+        case_id_input = gr.Textbox(label="Case ID (optional, only new or changed images of the case are analyzed again)")
+        profile_input = gr.Dropdown(list(PROFILES), value=DEFAULT_PROFILE, label="Profile (faster or more thorough report)")
     
     with gr.Row():
         submit_btn = gr.Button("Process Images")
@@ -80,7 +151,7 @@ with gr.Blocks() as demo:
         output = gr.Markdown(label="Processing Results")
     
     # Connect the submit button to process images
-    submit_btn.click(fn=process_images, inputs=[image_input], outputs=[output])
+    submit_btn.click(fn=process_images, inputs=[image_input, case_id_input, profile_input], outputs=[output])
 
 if __name__ == "__main__":
     demo.launch(server_name="0.0.0.0", server_port=7860)
\ No newline at end of file
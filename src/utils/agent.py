@@ -1,11 +1,18 @@
 from pprint import pprint
 from langchain_core.runnables import Runnable
+from langchain_core.runnables.config import patch_config
 from langchain_core.messages import AnyMessage
 from langchain_openai import ChatOpenAI
 from langgraph.prebuilt import create_react_agent
+from langgraph.errors import GraphRecursionError
 from utils.state import ImageProcessingState, ReportSchema
 from utils.tools import select_relevant_images, analyze_images, ddg_search
-from utils.examples import REPORT_EXAMPLE
+from utils.prompts import system_prompt, REFINE_INSTRUCTIONS
+from utils.run_context import run_scope
+from utils.clients import get_http_client
+from utils.config import AGENT_RECURSION_LIMIT
+
+import threading
 
 class RefiningAgent(Runnable):
     """
@@ -15,7 +22,32 @@ class RefiningAgent(Runnable):
         This agent inherits from Runnable and uses LangGraph's ReAct agent pattern
         to iteratively improve reports by identifying missing information and
         using tools to fill in the gaps.
+
+        The chat model and the ReAct agent are built once and shared by every run
+        of a pipeline profile.
     """
+    def __init__(self, model: str = "o3-mini"):
+        self.model = model
+        self._agent = None
+        self._lock = threading.Lock()
+
+    def get_agent(self) -> Runnable:
+        """
+        Return the compiled ReAct agent, building it on first use.
+
+        Returns:
+            Runnable: The compiled agent
+        """
+        if self._agent is None:
+            with self._lock:
+                if self._agent is None:
+                    model = ChatOpenAI(model=self.model, http_client=get_http_client())
+                    tools = [select_relevant_images, analyze_images, ddg_search]
+                    model = model.bind_tools(tools)
+                    # Create the langgraph react agent
+                    self._agent = create_react_agent(model=model, tools=tools, response_format=ReportSchema, debug=True)
+        return self._agent
+
     def system_prompt(self) -> list[AnyMessage]:
         """
         Create the system prompt for the refining agent.
@@ -25,62 +57,41 @@ class RefiningAgent(Runnable):
                              the agent on how to refine reports.
         """
 
-        system_msg = f"""
-        You are an assistant who is helping to refine a report about an object used as collateral. You need to identify parts of the report which contain missing or incomplete information and augment it by looking at images of the object. After identifying missing information, you should look for the relevant images and analyze them to find the missing information.
-                                                    
-        Here are examples of complete reports:
-        {REPORT_EXAMPLE}
-
-        You have access to the following tools:
-        - select_relevant_images
-        - analyze_images
-        - ddg_search
-
-        Always use tools to refine the report. If you use the ddg_search, indicate that the information is from a web search.
-
-        Use the following format:
-
-        Question: the report which you need to refine
-        Thought: you should always think about what to do
-        Action: the action to take should be one of the following: select_relevant_images, analyze_images, ddg_search
-        Action Input: the input to the action
-        Observation: the result of the action
-        ... (this Thought/Action/Action Input/Observation can repeat N times)
-        Thought: I now know the final answer
-        Final Answer: ONLY the modified final report in markdown format, without the level 3 headers (###)
-        """
-
-        return [{"role": "system", "content": system_msg}]
+        return [{"role": "system", "content": system_prompt(REFINE_INSTRUCTIONS)}]
 
     def invoke(self, state: ImageProcessingState, config = None) -> ImageProcessingState:
         """
             Process the current state and refine the report using a LangGraph ReAct agent.
             
-            The agent analyzes the current report, identifies missing information,
-            and uses tools to gather additional details from images and web searches.
+            The agent receives the current report and its missing fields found by
+            check_completeness, and uses tools to gather those details from images
+            and web searches.
             
             Args:
                 state (ImageProcessingState): The current state containing the report to refine
-                config: Optional configuration for the agent execution
+                config: Config of the calling graph, its callbacks and tracing are passed on to the agent
                 
             Returns:
                 ImageProcessingState: Updated state with the refined report
         """
-        
-        model = ChatOpenAI(model="o3-mini")
-        tools = [select_relevant_images, analyze_images, ddg_search]
-        model = model.bind_tools(tools)
-        # Create the langgraph react agent
-        agent = create_react_agent(model=model, tools=tools, response_format=ReportSchema, debug=True)
-        
+        agent = self.get_agent()
+
         report = state["final_report_markdown"]
         
         system_message = self.system_prompt()
-        # In langgraph, the agent is directly invokable
-        result = agent.invoke({
-            "messages": system_message +[{"role": "user", "content": f"Modify this report based on your findings: {report}"}]
-        })
-        
+        # The tools find the images and features of this run through the run ID in the config
+        with run_scope(state) as run:
+            try:
+                # In langgraph, the agent is directly invokable
+                missing_fields = "\n".join(f"- {field}" for field in state["missing_fields"])
+                result = agent.invoke({
+                    "messages": system_message +[{"role": "user", "content": f"Modify this report based on your findings: {report}\n\nOnly look for the following missing or unclear fields:\n{missing_fields}"}]
+                }, config=patch_config(config, configurable={"run_id": state["run_id"]}, recursion_limit=AGENT_RECURSION_LIMIT))
+            except GraphRecursionError:
+                # The refinement is optional, the report of the previous stages is kept
+                print(f"[WARNING] The refining agent did not finish within {AGENT_RECURSION_LIMIT} steps ({run.tool_calls} tool calls), keeping the unrefined report")
+                return state
+
         # Extract the final answer from the messages
         print("[DEBUG] Agent tought process:")
         pprint(result["messages"])
@@ -0,0 +1,189 @@
+"""
+This module contains a small disk-backed key/value cache and the cache instances shared by the pipeline.
+"""
+
+from utils.config import env_int, env_float
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+
+def content_hash(*parts: bytes | str) -> str:
+    """
+    Create a stable SHA-256 hex digest from the given parts.
+
+    Args:
+        *parts (bytes | str): Values that together identify a cache entry
+
+    Returns:
+        str: Hex digest of the parts
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    A content-addressed cache which stores JSON values as files in a directory.
+
+    Entries older than max_age_seconds are treated as missing and removed. When the
+    cache grows over max_entries or max_bytes, the least recently used entries are
+    evicted. Writes are atomic, so several workers can share the same directory.
+    """
+
+    EVICTION_INTERVAL = 16
+
+    def __init__(self, directory: str, max_entries: int, max_bytes: int, max_age_seconds: float):
+        """
+        Initialize the cache and create its directory.
+
+        Args:
+            directory (str): Directory where the entries are stored
+            max_entries (int): Maximum number of entries kept on disk
+            max_bytes (int): Maximum total size of the entries in bytes
+            max_age_seconds (float): Age after which an entry expires
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str):
+        """
+        Look up an entry.
+
+        Args:
+            key (str): Key of the entry, usually created with content_hash()
+
+        Returns:
+            The stored value, or None if the entry is missing or expired
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is not None and time.time() - entry["created"] > self.max_age_seconds:
+            self._remove(path)
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        # The modification time is used as the last access time for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["value"]
+
+    def set(self, key: str, value) -> None:
+        """
+        Store an entry, replacing any previous value.
+
+        Args:
+            key (str): Key of the entry
+            value: JSON serializable value to store
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"created": time.time(), "value": value}, f)
+        os.replace(tmp_path, self._path(key))
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.EVICTION_INTERVAL == 1
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove expired entries, then the least recently used ones until the cache fits its limits.
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                # Leftover of an interrupted write
+                if name.endswith(".tmp"):
+                    path = os.path.join(self.directory, name)
+                    try:
+                        if now - os.stat(path).st_mtime > 3600:
+                            self._remove(path)
+                    except OSError:
+                        pass
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # Entries not even read within max_age are surely expired, get() checks the exact age
+            if now - stat.st_mtime > self.max_age_seconds:
+                self._remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+            _, size, path = entries.pop(0)
+            self._remove(path)
+            total_bytes -= size
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        """
+        Report the hit and miss counts of this process.
+
+        Returns:
+            dict: Number of hits, misses and the hit ratio
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+description_cache = DiskCache(
+    os.getenv("DESCRIPTION_CACHE_DIR", os.path.join(os.getcwd(), "data", "cache", "descriptions")),
+    max_entries=env_int("DESCRIPTION_CACHE_MAX_ENTRIES", 10000),
+    max_bytes=env_int("DESCRIPTION_CACHE_MAX_MB", 200) * 1024 * 1024,
+    max_age_seconds=env_float("DESCRIPTION_CACHE_MAX_AGE_DAYS", 30) * 24 * 3600,
+)
+
+search_cache = DiskCache(
+    os.getenv("SEARCH_CACHE_DIR", os.path.join(os.getcwd(), "data", "cache", "search")),
+    max_entries=env_int("SEARCH_CACHE_MAX_ENTRIES", 5000),
+    max_bytes=env_int("SEARCH_CACHE_MAX_MB", 20) * 1024 * 1024,
+    max_age_seconds=env_float("SEARCH_CACHE_MAX_AGE_DAYS", 7) * 24 * 3600,
+)
@@ -0,0 +1,94 @@
+"""
+This module stores the intermediate results of a case, so an updated case only costs as much as its change.
+
+A case is identified by a case ID given with the request. Its record keeps the description of
+every image by the hash of the preprocessed image, and the aggregated information together with
+the image hashes it was created from. A new request for the same case only describes the new or
+changed images, drops the descriptions of deleted images, and reuses the aggregation if the
+images did not change at all.
+"""
+
+import os
+import re
+import json
+import tempfile
+import threading
+
+CASE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+def is_valid_case_id(case_id: str) -> bool:
+    """
+    Check whether a case ID can be used as a directory name.
+
+    Args:
+        case_id (str): The case ID
+
+    Returns:
+        bool: True if the ID has 1 to 64 letters, digits, underscores or dashes
+    """
+    return bool(CASE_ID_PATTERN.match(case_id or ""))
+
+
+class CaseStore:
+    """
+    Keeps one JSON record per case in <directory>/<case_id>/case.json.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Initialize the store.
+
+        Args:
+            directory (str): Directory of the case records
+        """
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._case_locks = {}
+
+    def _path(self, case_id: str) -> str:
+        if not is_valid_case_id(case_id):
+            raise ValueError(f"Invalid case ID {case_id!r}")
+        return os.path.join(self.directory, case_id, "case.json")
+
+    def load(self, case_id: str) -> dict:
+        """
+        Load the record of a case.
+
+        Args:
+            case_id (str): The case ID
+
+        Returns:
+            dict: The record, with empty "images" and no "aggregated_info" for a new case
+        """
+        try:
+            with open(self._path(case_id), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"images": {}, "aggregated_info": None, "aggregated_from": None}
+
+    def update(self, case_id: str, **fields) -> None:
+        """
+        Set fields of a case's record. Concurrent updates of the same case in this process are serialized.
+
+        Args:
+            case_id (str): The case ID
+            **fields: The fields to set, e.g. images=... or aggregated_info=...
+        """
+        with self._lock:
+            case_lock = self._case_locks.setdefault(case_id, threading.Lock())
+        with case_lock:
+            record = self.load(case_id)
+            record.update(fields)
+            self._save(case_id, record)
+
+    def _save(self, case_id: str, record: dict) -> None:
+        path = self._path(case_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f, indent=4)
+        os.replace(tmp_path, path)
+
+
+case_store = CaseStore(os.getenv("CASE_STORE_DIR", os.path.join(os.getcwd(), "data", "cases")))
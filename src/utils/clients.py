@@ -0,0 +1,68 @@
+"""
+This module holds the OpenAI clients shared by the whole process.
+
+All clients use one keep-alive connection pool per process, so the pipeline stages, the agent
+and the tools reuse connections instead of opening a new pool and doing new TLS handshakes for
+every LLM object.
+"""
+
+from openai import OpenAI, DefaultHttpxClient
+from utils.config import env_int, env_float
+
+import threading
+import httpx
+
+MAX_CONNECTIONS = env_int("OPENAI_MAX_CONNECTIONS", 64)
+MAX_KEEPALIVE_CONNECTIONS = env_int("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 32)
+KEEPALIVE_EXPIRY = env_float("OPENAI_KEEPALIVE_EXPIRY", 60)
+TIMEOUT = env_float("OPENAI_TIMEOUT", 120)
+CONNECT_TIMEOUT = env_float("OPENAI_CONNECT_TIMEOUT", 10)
+
+_http_client = None
+_client = None
+_lock = threading.Lock()
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Return the process-wide HTTP client with the pooled connections.
+
+    Returns:
+        httpx.Client: The shared HTTP client, also usable by ChatOpenAI
+    """
+    global _http_client
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                _http_client = DefaultHttpxClient(limits=_limits(), timeout=_timeout())
+    return _http_client
+
+
+def get_client() -> OpenAI:
+    """
+    Return the process-wide OpenAI client. The client is thread-safe.
+
+    Returns:
+        OpenAI: The shared client
+    """
+    global _client
+    if _client is None:
+        http_client = get_http_client()
+        with _lock:
+            if _client is None:
+                # Retries are done by the scheduler, which knows about the rate limits
+                _client = OpenAI(http_client=http_client, timeout=_timeout(), max_retries=0)
+    return _client
+
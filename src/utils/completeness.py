@@ -0,0 +1,120 @@
+"""
+This module checks the aggregated report for missing information without calling a model.
+
+A field is missing if its section of the aggregated_info JSON is empty, if its value is empty or
+only says that it is unclear, or if the example report which matches the asset best has it in
+the identification section and the report does not.
+"""
+
+from utils.examples import REPORT_EXAMPLE, OUTPUT_FORMAT
+
+import re
+import json
+
+# "- **Label:** value" and "- **Label**: value" lines of the report and of the examples
+FIELD_PATTERN = re.compile(r"^\s*(?:[-*]\s*)?\*\*([^*]+?)(?::\*\*|\*\*:)\s*(.*)$")
+UNCLEAR_PATTERN = re.compile(
+    r"\b(unclear|not (?:clearly )?visible|unknown|not known|not available|n/a|not specified|not determined|"
+    r"cannot be determined|could not be determined|not provided|not identifiable|illegible|not legible|to be confirmed)\b",
+    re.IGNORECASE,
+)
+# Longer values which mention one of the phrases above are assessments, not placeholders
+MAX_PLACEHOLDER_WORDS = 10
+# Share of the report's identification labels an example needs to have to be compared with
+MIN_EXAMPLE_OVERLAP = 0.5
+
+SECTIONS = OUTPUT_FORMAT["json_schema"]["schema"]["required"]
+SECTION_TITLES = {
+    "identification": "Identification & General Data",
+    "inspection_methods": "Inspection Methods",
+    "condition_assessment": "Condition Assessment",
+    "documentation_and_accessories": "Documentation & Accessories",
+}
+
+
+def parse_fields(text: str) -> dict[str, str]:
+    """
+    Extract the labelled fields of a report section.
+
+    Args:
+        text (str): The section text
+
+    Returns:
+        dict[str, str]: The values by label
+    """
+    fields = {}
+    for line in text.splitlines():
+        match = FIELD_PATTERN.match(line)
+        if match:
+            fields[match.group(1).strip()] = match.group(2).strip()
+    return fields
+
+
+def example_identification_fields() -> list[dict[str, str]]:
+    """
+    Collect the labels of the identification section of every example report.
+
+    Returns:
+        list[dict[str, str]]: The labels by their lowercase form, one dict per example
+    """
+    examples = []
+    for example in re.split(r"^Example \d+:\s*$", REPORT_EXAMPLE, flags=re.MULTILINE)[1:]:
+        section = example.split("### Identification & General Data", 1)[-1].split("###", 1)[0]
+        examples.append({label.lower(): label for label in parse_fields(section)})
+    return examples
+
+
+EXAMPLE_IDENTIFICATION_FIELDS = example_identification_fields()
+
+
+def is_placeholder(value: str) -> bool:
+    """
+    Check whether a field value carries no information.
+
+    Args:
+        value (str): The value of a field
+
+    Returns:
+        bool: True if the value is empty or only states that the information is unclear
+    """
+    value = value.strip(" .-?")
+    return not value or (UNCLEAR_PATTERN.search(value) is not None and len(value.split()) <= MAX_PLACEHOLDER_WORDS)
+
+
+def find_missing_fields(aggregated_info: str) -> list[str]:
+    """
+    List the missing or unclear fields of the aggregated report.
+
+    Args:
+        aggregated_info (str): The JSON report created by aggregate_info
+
+    Returns:
+        list[str]: Missing fields as "<section>: <label>", or "<section>" if a whole section is missing
+    """
+    try:
+        report = json.loads(aggregated_info)
+    except (TypeError, ValueError):
+        # A report which cannot be read is refined as a whole
+        return [SECTION_TITLES[section] for section in SECTIONS]
+
+    missing = []
+    for section in SECTIONS:
+        text = str(report.get(section) or "").replace("\\n", "\n")
+        fields = parse_fields(text)
+        # A section with labelled fields is judged by its fields, a placeholder word in one of
+        # them does not make the whole section missing
+        if not fields and is_placeholder(text):
+            missing.append(SECTION_TITLES[section])
+            continue
+
+        missing.extend(f"{SECTION_TITLES[section]}: {label}" for label, value in fields.items() if is_placeholder(value))
+
+        if section == "identification" and fields:
+            # Compare with the example of the same kind of asset, if there is one
+            labels = {label.lower() for label in fields}
+            overlaps = [len(labels & example.keys()) / len(labels) for example in EXAMPLE_IDENTIFICATION_FIELDS]
+            if overlaps and max(overlaps) >= MIN_EXAMPLE_OVERLAP:
+                example = EXAMPLE_IDENTIFICATION_FIELDS[overlaps.index(max(overlaps))]
+                missing.extend(f"{SECTION_TITLES[section]}: {label}" for key, label in example.items() if key not in labels)
+
+    return missing
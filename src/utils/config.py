@@ -0,0 +1,94 @@
+"""
+This module contains the runtime settings of the pipeline. Every value can be overridden with an environment variable (or the .env file).
+"""
+
+from dotenv import load_dotenv
+
+import os
+
+load_dotenv()
+
+
+def env_int(name: str, default: int) -> int:
+    """
+    Read an integer setting from the environment.
+
+    Args:
+        name (str): Name of the environment variable
+        default (int): Value used when the variable is not set
+
+    Returns:
+        int: The configured value
+    """
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def env_float(name: str, default: float) -> float:
+    """
+    Read a float setting from the environment.
+
+    Args:
+        name (str): Name of the environment variable
+        default (float): Value used when the variable is not set
+
+    Returns:
+        float: The configured value
+    """
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+# "concurrent" describes every image independently and in parallel, "sequential" feeds
+# the earlier descriptions into each next call (the original behaviour).
+DESCRIBE_MODE = os.getenv("DESCRIBE_MODE", "concurrent")
+DESCRIBE_CONCURRENCY = env_int("DESCRIBE_CONCURRENCY", 8)
+
+# Images are downscaled so that their longer side is at most PREPROCESS_MAX_DIMENSION pixels,
+# re-encoded in PREPROCESS_FORMAT and stripped of their metadata before upload, on a pool of
+# PREPROCESS_WORKERS worker processes which is shared by every run of the process
+PREPROCESS_MAX_DIMENSION = env_int("PREPROCESS_MAX_DIMENSION", 2048)
+PREPROCESS_FORMAT = os.getenv("PREPROCESS_FORMAT", "JPEG")
+PREPROCESS_QUALITY = env_int("PREPROCESS_QUALITY", 85)
+PREPROCESS_WORKERS = env_int("PREPROCESS_WORKERS", os.cpu_count() or 1)
+
+# select_relevant_images returns the INDEX_TOP_K images closest to the question. With
+# INDEX_RERANK enabled, twice as many candidates are re-ranked by an LLM.
+INDEX_TOP_K = env_int("INDEX_TOP_K", 5)
+INDEX_RERANK = os.getenv("INDEX_RERANK", "false").lower() in ("1", "true", "yes")
+
+# analyze_images looks at up to ANALYZE_CONCURRENCY images at a time. Once one image answers with
+# a confidence of at least ANALYZE_CONFIDENCE_THRESHOLD, the remaining lookups are cancelled
+# (a threshold above 1 disables the early exit).
+ANALYZE_CONCURRENCY = env_int("ANALYZE_CONCURRENCY", 4)
+ANALYZE_CONFIDENCE_THRESHOLD = env_float("ANALYZE_CONFIDENCE_THRESHOLD", 0.9)
+
+# With FIND_MODE "two_pass", find_information first locates the requested information on a low
+# detail overview of the image and then reads a high resolution crop of that region, cut from the
+# original file with CROP_PADDING margin. Regions larger than MAX_CROP_AREA of the image, and
+# images where nothing is found, are read whole as with FIND_MODE "single". Up to
+# CROP_CACHE_ENTRIES crops and CROP_CACHE_MAX_MB megabytes of crops are kept in memory.
+FIND_MODE = os.getenv("FIND_MODE", "two_pass")
+CROP_PADDING = env_float("CROP_PADDING", 0.05)
+MAX_CROP_AREA = env_float("MAX_CROP_AREA", 0.6)
+CROP_CACHE_ENTRIES = env_int("CROP_CACHE_ENTRIES", 256)
+CROP_CACHE_MAX_MB = env_int("CROP_CACHE_MAX_MB", 32)
+
+# Hard limits of the refining agent: graph steps (two per tool round) and tool calls which are
+# actually executed per run. Repeated tool calls are answered from the run's memo and not counted.
+AGENT_RECURSION_LIMIT = env_int("AGENT_RECURSION_LIMIT", 25)
+AGENT_MAX_TOOL_CALLS = env_int("AGENT_MAX_TOOL_CALLS", 10)
+
+# "online" searches the web and caches the results, "cache_only" only answers from the search
+# cache and "offline" disables the web search, e.g. for benchmarks and air-gapped deployments.
+SEARCH_MODE = os.getenv("SEARCH_MODE", "online")
+
+# preprocess_images groups images whose perceptual hashes differ in at most TRIAGE_HASH_DISTANCE of
+# 64 bits and describes only the sharpest image of each group. The scores are computed on images
+# downsampled to TRIAGE_SIZE pixels.
+TRIAGE_ENABLED = os.getenv("TRIAGE_ENABLED", "true").lower() in ("1", "true", "yes")
+TRIAGE_HASH_DISTANCE = env_int("TRIAGE_HASH_DISTANCE", 6)
+TRIAGE_SIZE = env_int("TRIAGE_SIZE", 512)
+# Images whose sharpness (variance of the Laplacian at TRIAGE_SIZE) is below TRIAGE_MIN_SHARPNESS,
+# and that have no sharper near-duplicate, are too blurry to be described (0 disables the check).
+TRIAGE_MIN_SHARPNESS = env_float("TRIAGE_MIN_SHARPNESS", 10.0)
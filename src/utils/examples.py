@@ -133,4 +133,27 @@ OUTPUT_FORMAT = {
                         ]
                     }
                 }
-            }
\ No newline at end of file
+            }
+
+
+REGION_FORMAT = {
+                "type": "json_schema",
+                "name": "image_region",
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "found": {
+                            "type": "boolean",
+                            "description": "Whether the information is visible in the image"
+                            },
+                        "box": {
+                            "type": "array",
+                            "items": {"type": "number"},
+                            "description": "Left, top, right and bottom edge of the region as fractions of the image width and height"
+                            },
+                        },
+                    "required": ["found", "box"],
+                    "additionalProperties": False
+                    },
+                "strict": True
+                }
@@ -0,0 +1,124 @@
+"""
+This module keeps track of the images uploaded to OpenAI, so the same content is only uploaded once per process.
+"""
+
+from utils.cache import content_hash
+from utils.config import env_float
+from utils.metrics import UPLOAD_BYTES
+from utils.scheduler import scheduler
+
+import time
+import threading
+
+# Rate limit queue of the file uploads and deletions in the scheduler, they do not use a model
+FILES_QUEUE = "files"
+
+
+class FileRegistry:
+    """
+    A process-wide registry which maps image content hashes to uploaded OpenAI file IDs.
+
+    The registry is shared by the pipeline nodes and the agent tools. Uploads older than
+    ttl_seconds are considered stale: they are uploaded again on the next use and the old
+    file is deleted from OpenAI.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        """
+        Initialize an empty registry.
+
+        Args:
+            ttl_seconds (float): Time after which an uploaded file is no longer reused
+        """
+        self.ttl_seconds = ttl_seconds
+        self.uploads = 0
+        self.reuses = 0
+        self.bytes_uploaded = 0
+        self.bytes_avoided = 0
+        self._files = {}
+        self._stale = []
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get_or_upload(self, client, data: bytes, filename: str) -> str:
+        """
+        Return the file ID of the given content, uploading it only if it is not registered yet.
+
+        Args:
+            client (OpenAI): Client used for the upload
+            data (bytes): Content of the file
+            filename (str): Name sent with the upload
+
+        Returns:
+            str: The file ID assigned by OpenAI
+        """
+        key = content_hash(data)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Concurrent requests for the same content wait for a single upload
+        with key_lock:
+            with self._lock:
+                entry = self._files.get(key)
+                if entry is not None and time.time() - entry["uploaded_at"] <= self.ttl_seconds:
+                    self.reuses += 1
+                    self.bytes_avoided += len(data)
+                    UPLOAD_BYTES.labels("avoided").inc(len(data))
+                    return entry["file_id"]
+                if entry is not None:
+                    self._stale.append(entry["file_id"])
+
+            # The client does not retry on its own, the scheduler retries transient errors
+            result = scheduler.run(FILES_QUEUE, 0, lambda: client.files.create(
+                file=(filename, data),
+                purpose="vision",
+            ), operation="upload")
+
+            with self._lock:
+                self._files[key] = {"file_id": result.id, "uploaded_at": time.time()}
+                self.uploads += 1
+                self.bytes_uploaded += len(data)
+                UPLOAD_BYTES.labels("uploaded").inc(len(data))
+
+        self.cleanup_stale(client)
+        return result.id
+
+    def cleanup_stale(self, client) -> None:
+        """
+        Delete expired uploads from OpenAI.
+
+        Args:
+            client (OpenAI): Client used for the deletion
+        """
+        now = time.time()
+        with self._lock:
+            for key, entry in list(self._files.items()):
+                if now - entry["uploaded_at"] > self.ttl_seconds:
+                    self._stale.append(entry["file_id"])
+                    del self._files[key]
+                    self._key_locks.pop(key, None)
+            stale, self._stale = self._stale, []
+
+        for file_id in stale:
+            try:
+                scheduler.run(FILES_QUEUE, 0, lambda: client.files.delete(file_id), operation="delete")
+            except Exception as e:
+                print(f"[WARNING] Could not delete stale file {file_id}: {e}")
+
+    def stats(self) -> dict:
+        """
+        Report how many uploads were made and avoided.
+
+        Returns:
+            dict: Upload and reuse counts and the uploaded and avoided bytes
+        """
+        with self._lock:
+            return {
+                "uploads": self.uploads,
+                "reuses": self.reuses,
+                "bytes_uploaded": self.bytes_uploaded,
+                "bytes_avoided": self.bytes_avoided,
+            }
+
+
+file_registry = FileRegistry(ttl_seconds=env_float("FILE_ID_TTL_SECONDS", 3600))
@@ -1,31 +1,132 @@
-from PIL import Image
+from langgraph.types import StreamWriter
 from utils.model import LLM
-from utils.examples import REPORT_EXAMPLE
+from utils.prompts import system_prompt, fit_to_budget, AGGREGATE_INSTRUCTIONS, FINISH_INSTRUCTIONS, SINGLE_PASS_INSTRUCTIONS
 from utils.state import ImageProcessingState, ReportSchema
+from utils.config import DESCRIBE_MODE, DESCRIBE_CONCURRENCY, PREPROCESS_MAX_DIMENSION, PREPROCESS_FORMAT, PREPROCESS_QUALITY, TRIAGE_ENABLED, TRIAGE_HASH_DISTANCE, TRIAGE_MIN_SHARPNESS
+from utils.cache import description_cache
+from utils.cases import case_store
+from utils.files import file_registry
+from utils.run_context import get_workspace, save_image_data, load_image_data
+from utils.completeness import find_missing_fields
+from utils.profiles import get_profile
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from utils.images import get_process_pool, reset_process_pool, triage_image, preprocess_image
 
 import os
+import re
 import yaml
 import json
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
 
 def load_images(state: ImageProcessingState) -> ImageProcessingState: 
     """
-    Load images from a directory and return them as a list of PIL Image objects.
+    Find the images in the state's directory and record their names and paths.
+
+    Only paths are kept in the state, so it can be stored by the checkpointer. The images
+    are opened by preprocess_images.
     
     Args:
-        images_dir (str): The directory containing the images.
+        state (ImageProcessingState): The current state containing the images directory
     
     Returns:
-        list: A list of PIL Image objects.
+        ImageProcessingState: Updated state with the image names and paths
     """
-    for filename in os.listdir(state["images_dir"]):
-        if filename.endswith(".jpg") or filename.endswith(".png"):
+    for filename in sorted(os.listdir(state["images_dir"])):
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
             img_path = os.path.join(state["images_dir"], filename)
-            state["images"].append(Image.open(img_path))
             state["image_names"].append(filename)
             state["image_paths"].append(img_path)
 
-    print(f"Loaded {len(state['images'])} images from {state['images_dir']}")
+    print(f"Loaded {len(state['image_paths'])} images from {state['images_dir']}")
+    return state
+
+def group_images(image_paths: list[str], scores: dict[str, tuple[int, float]]) -> dict[str, list[str]]:
+    """
+        Group near-duplicate images by their perceptual hashes and drop the blurry groups.
+
+        Images whose hashes differ in at most TRIAGE_HASH_DISTANCE bits are put into one group.
+        A group whose sharpest image is below TRIAGE_MIN_SHARPNESS is dropped, unless every
+        group is that blurry, in which case the sharpest group is kept.
+
+        Args:
+            image_paths (list[str]): Paths of the images, in the order of the run
+            scores (dict[str, tuple[int, float]]): Hash and sharpness of every image, see triage_image()
+
+        Returns:
+            dict[str, list[str]]: The groups which are described, by their sharpest image
+    """
+    groups = []
+    for img_path in image_paths:
+        image_hash_value = scores[img_path][0]
+        for group in groups:
+            # Bursts are compared with the first image of the group
+            if bin(image_hash_value ^ scores[group[0]][0]).count("1") <= TRIAGE_HASH_DISTANCE:
+                group.append(img_path)
+                break
+        else:
+            groups.append([img_path])
+
+    groups = {max(group, key=lambda path: scores[path][1]): group for group in groups}
+    sharp_groups = {best: group for best, group in groups.items() if scores[best][1] >= TRIAGE_MIN_SHARPNESS}
+    if groups and not sharp_groups:
+        best = max(groups, key=lambda path: scores[path][1])
+        sharp_groups = {best: groups[best]}
+    return sharp_groups
+
+def preprocess_images(state: ImageProcessingState) -> ImageProcessingState:
+    """
+        Group near-duplicate images, then downscale, re-encode and strip the metadata of the
+        best image of every group before it is uploaded.
+
+        Both steps run on the process pool shared by every run (see utils/images.py). The triage step computes a perceptual difference hash
+        and a sharpness score (variance of the Laplacian) of every image over a reduced decode of
+        the original, and stores the groups in the state's image_groups by their sharpest image.
+        Groups which are too blurry are left out. Every image stays in image_paths, so the refine
+        tools can still use any of them. Only the best image of every group is preprocessed, the
+        later stages never read the other images.
+
+        The preprocessed bytes are stored in the run's workspace and are used by the later stages
+        instead of the original files. The state only keeps their content hashes in image_hashes,
+        keyed by image path, so the checkpoints stay small.
+
+        Args:
+            state (ImageProcessingState): The current state containing image paths
+
+        Returns:
+            ImageProcessingState: Updated state with the image groups and the hashes of the preprocessed images
+    """
+    executor = get_process_pool()
+    try:
+        if TRIAGE_ENABLED:
+            scores = dict(zip(state["image_paths"], executor.map(triage_image, state["image_paths"])))
+            state["image_groups"] = group_images(state["image_paths"], scores)
+            skipped = len(state["image_paths"]) - sum(len(group) for group in state["image_groups"].values())
+            print(f"Triage: {len(state['image_paths'])} images in {len(state['image_groups'])} groups of near-duplicates, {skipped} skipped as blurry")
+        else:
+            state["image_groups"] = {img_path: [img_path] for img_path in state["image_paths"]}
+
+        paths = [img_path for img_path in state["image_paths"] if img_path in state["image_groups"]]
+        results = executor.map(
+            preprocess_image,
+            paths,
+            [PREPROCESS_MAX_DIMENSION] * len(paths),
+            [PREPROCESS_FORMAT] * len(paths),
+            [PREPROCESS_QUALITY] * len(paths),
+        )
+        processed_size = 0
+        for img_path, data in zip(paths, results):
+            state["image_hashes"][img_path] = save_image_data(state["run_id"], data)
+            processed_size += len(data)
+    except BrokenProcessPool:
+        # A worker died, e.g. killed for its memory use; later runs get a new pool
+        reset_process_pool()
+        raise
+
+    original_size = sum(os.path.getsize(path) for path in paths)
+    print(f"Preprocessed {len(paths)} of {len(state['image_paths'])} images: {original_size / 1e6:.1f} MB -> {processed_size / 1e6:.1f} MB")
     return state
 
 def describe_images(state: ImageProcessingState) -> ImageProcessingState:
@@ -34,7 +135,17 @@ def describe_images(state: ImageProcessingState) -> ImageProcessingState:
         
         This function processes each image in the state, using a vision model to generate
         textual descriptions. The descriptions are stored in the state's features list.
-        Results are also saved to a YAML file for persistence.
+        Descriptions are persisted in the description cache, so resubmitted images are not
+        described again. The features are also written to a YAML file in the run's workspace
+        for debugging.
+
+        In "concurrent" mode (DESCRIBE_MODE) all images are described in parallel, at most
+        DESCRIBE_CONCURRENCY at a time, without the descriptions of the other images. In
+        "sequential" mode each image receives the earlier descriptions as context.
+
+        If the state has a case_id, the descriptions stored for the case are reused for the
+        unchanged images, only new or changed images are described, and the case's record is
+        updated to the current set of images.
         
         Args:
             state (ImageProcessingState): The current state containing image paths
@@ -42,39 +153,127 @@ def describe_images(state: ImageProcessingState) -> ImageProcessingState:
         Returns:
             ImageProcessingState: Updated state with extracted features from images
     """
-    # Create data directory if it doesn't exist
-    data_dir = os.path.join(os.getcwd(), "data", "runs")
-    os.makedirs(data_dir, exist_ok=True)
-    features_path = os.path.join(data_dir, "features.yaml")
-
-    # Uncomment this to start from a saved state
-    # features_path = os.path.join(data_dir, "features.yaml")
-    # with open(features_path, "r") as f:
-    #     state["features"] = yaml.safe_load(f)
-    # return state
+    features_path = os.path.join(get_workspace(state["run_id"]), "features.yaml")
 
     vision_model = LLM()
+    model = get_profile(state["profile"])["describe_model"]
+
+    # Of every group of near-duplicates found by preprocess_images only the best image is described
+    described_paths = [img_path for img_path in state["image_paths"] if img_path in state["image_groups"]] if state["image_groups"] else state["image_paths"]
 
-    for img_path in state["image_paths"]:
-        print(img_path)
-        extracted_text = vision_model.describe_image(img_path, "\n".join(feature['extracted_text'] for feature in state["features"]))
-        state["features"].append({"image_path": img_path, "extracted_text": extracted_text})
-        print(f"Extracted text ({img_path}):\n{extracted_text}\n{'-'*20}")
+    # The descriptions of the case's unchanged images are taken from the case store
+    descriptions = {}
+    if state.get("case_id"):
+        stored_images = case_store.load(state["case_id"])["images"]
+        for img_path in described_paths:
+            stored = stored_images.get(image_hash(state, img_path))
+            if stored is not None and stored.get("model") == model:
+                descriptions[img_path] = stored["extracted_text"]
+    new_paths = [img_path for img_path in described_paths if img_path not in descriptions]
 
-    print(f"Extracted text from {len(state['image_paths'])} images.")
+    if DESCRIBE_MODE == "sequential":
+        for img_path in new_paths:
+            print(img_path)
+            extracted_text = vision_model.describe_image(img_path, "\n".join(descriptions.values()), model=model, image_data=load_image_data(state["run_id"], state["image_hashes"][img_path]))
+            descriptions[img_path] = extracted_text
+            print(f"Extracted text ({img_path}):\n{extracted_text}\n{'-'*20}")
+    else:
+        # Every image is described on its own, repeated facts are removed later by merge_features.
+        # The context is copied into the threads, so the requests keep the priority of the run.
+        with ContextThreadPoolExecutor(max_workers=max(1, DESCRIBE_CONCURRENCY)) as executor:
+            results = executor.map(lambda img_path: vision_model.describe_image(img_path, "", model=model, image_data=load_image_data(state["run_id"], state["image_hashes"][img_path])), new_paths)
+            for img_path, extracted_text in zip(new_paths, results):
+                descriptions[img_path] = extracted_text
+                print(f"Extracted text ({img_path}):\n{extracted_text}\n{'-'*20}")
+
+    state["features"] = [
+        {"image_path": img_path, "extracted_text": descriptions[img_path], "similar_images": [path for path in state["image_groups"].get(img_path, []) if path != img_path]}
+        for img_path in described_paths
+    ]
+
+    if state.get("case_id"):
+        # Only the current images are kept, so the descriptions of deleted images are dropped
+        case_store.update(state["case_id"], images={
+            image_hash(state, img_path): {"image_name": img_name, "extracted_text": descriptions[img_path], "model": model}
+            for img_path, img_name in zip(state["image_paths"], state["image_names"]) if img_path in descriptions
+        })
+
+    print(f"Described {len(new_paths)} of {len(state['image_paths'])} images ({len(described_paths)} after triage). Description cache: {description_cache.stats()}, uploads: {file_registry.stats()}")
 
     with open(features_path, "w") as f:
         yaml.dump(state["features"], f)
     
     return state
 
+def image_hash(state: ImageProcessingState, img_path: str) -> str:
+    """
+        Return the content hash of a preprocessed image, its key in the case store.
+
+        Args:
+            state (ImageProcessingState): The current state containing the hashes of the preprocessed images
+            img_path (str): Path of the image
+
+        Returns:
+            str: Hex digest of the preprocessed image
+    """
+    return state["image_hashes"][img_path]
+
+def merge_features(state: ImageProcessingState) -> ImageProcessingState:
+    """
+        Remove facts repeated across image descriptions.
+
+        When images are described independently, the same details (brand, model, colour...)
+        show up in many descriptions. This function keeps the first occurrence of every
+        fact line and drops the later repeats, so the aggregation prompt stays short.
+        Headings and blank lines are always kept.
+
+        Args:
+            state (ImageProcessingState): The current state containing extracted features
+
+        Returns:
+            ImageProcessingState: Updated state with deduplicated features
+    """
+    seen = set()
+    removed = 0
+
+    for feature in state["features"]:
+        kept_lines = []
+        for line in feature["extracted_text"].splitlines():
+            key = normalize_fact(line)
+            if key and not line.lstrip().startswith("#"):
+                if key in seen:
+                    removed += 1
+                    continue
+                seen.add(key)
+            kept_lines.append(line)
+        feature["extracted_text"] = "\n".join(kept_lines).strip()
+
+    print(f"Removed {removed} repeated facts from {len(state['features'])} image descriptions.")
+    return state
+
+def normalize_fact(line: str) -> str:
+    """
+        Normalize a description line so that trivially different repeats compare equal.
+
+        Args:
+            line (str): A single line of an image description
+
+        Returns:
+            str: Lowercase line without markdown markers and punctuation, or an empty string
+                 if the line carries no content
+    """
+    line = re.sub(r"^[\s\-\*\d\.\)#>]+", "", line.lower())
+    line = re.sub(r"[^\w\s]", " ", line)
+    return " ".join(line.split())
+
 def aggregate_info(state: ImageProcessingState) -> ImageProcessingState:
     """
         Aggregate information from all image descriptions into a structured report.
         
         This function uses an LLM to analyze all extracted text features and generate
         a comprehensive report in JSON format. The report is then converted to markdown
-        and stored in the state.
+        and stored in the state. For a case whose images did not change since its last run,
+        the stored aggregation is reused.
         
         Args:
             state (ImageProcessingState): The current state containing extracted features
@@ -83,52 +282,109 @@ def aggregate_info(state: ImageProcessingState) -> ImageProcessingState:
             ImageProcessingState: Updated state with aggregated information and markdown report
     """
 
-    data_dir = os.path.join(os.getcwd(), "data", "runs")
-    os.makedirs(data_dir, exist_ok=True)
-    aggreagated_info_path = os.path.join(data_dir, "aggregated_info.json")
+    aggreagated_info_path = os.path.join(get_workspace(state["run_id"]), "aggregated_info.json")
 
 
-    llm = LLM()
-    system_prompt = """
-    You are a helpful assistant who receives descriptions of multiple images of one object used as collateral and creates a report from it. A lot of images can focus on a certain part of an object, for example the tire of a car. Always focus on the object as a whole and not on a specific part in the report.
+    # An unchanged case reuses the aggregation made from the same images. Only the described images
+    # (the best image of every near-duplicate group) were preprocessed, and only their descriptions
+    # are aggregated, so they identify the aggregation.
+    model = get_profile(state["profile"])["aggregate_model"]
+    aggregated_from = {"model": model, "images": sorted(image_hash(state, feature["image_path"]) for feature in state["features"])}
+    record = case_store.load(state["case_id"]) if state.get("case_id") else None
+    if record is not None and record["aggregated_info"] is not None and record["aggregated_from"] == aggregated_from:
+        print(f"Reusing the aggregated information of case {state['case_id']}")
+        state["aggregated_info"] = record["aggregated_info"]
+    else:
+        llm = LLM()
+        # The descriptions are the only per-run text, the examples are part of the cached system prompt
+        features = '\n'.join(fit_to_budget([feature["extracted_text"] for feature in state['features']]))
+        user_prompt = f"Create a report from these image descriptions:\n{features}"
 
-    If you are unclear about an importart detail, indicate it in the report.
-    """
-    features = '\n'.join(feature["extracted_text"] for feature in state['features'])
-    user_prompt = f"Create a report from these image descriptions: {features}\n\nThese are examples on what a report should look like:\n{REPORT_EXAMPLE}"
-    
-    state["aggregated_info"] = llm.create_report(user_prompt, system_prompt, model="o4-mini")
+        state["aggregated_info"] = llm.create_report(user_prompt, system_prompt(AGGREGATE_INSTRUCTIONS), model=model)
+        if record is not None:
+            case_store.update(state["case_id"], aggregated_info=state["aggregated_info"], aggregated_from=aggregated_from)
 
     # Saving json for debug purposes
     with open(aggreagated_info_path, "w") as f:
         json.dump(state["aggregated_info"], f, indent=4)
 
-    # Uncomment this to start from a saved state
-    # with open(aggreagated_info_path, "r") as f:
-    #     state["aggregated_info"] = json.load(f)
+    state["final_report_markdown"] = json_to_markdown(state["aggregated_info"])
+    return state
+
+def write_report(state: ImageProcessingState) -> ImageProcessingState:
+    """
+        Write the finished report from the image descriptions in a single structured call.
+
+        This node replaces aggregate_info and finish_report in the graph of the "fast"
+        profile, which also skips the refinement.
+
+        Args:
+            state (ImageProcessingState): The current state containing extracted features
+
+        Returns:
+            ImageProcessingState: Updated state with aggregated information and the finished report
+    """
+    llm = LLM()
+    features = '\n'.join(fit_to_budget([feature["extracted_text"] for feature in state['features']]))
+    user_prompt = f"Create a finished report from these image descriptions:\n{features}"
 
+    state["aggregated_info"] = llm.create_report(user_prompt, system_prompt(SINGLE_PASS_INSTRUCTIONS), model=get_profile(state["profile"])["aggregate_model"])
     state["final_report_markdown"] = json_to_markdown(state["aggregated_info"])
     return state
 
-def finish_report(state: ImageProcessingState) -> ImageProcessingState:
+def check_completeness(state: ImageProcessingState) -> ImageProcessingState:
+    """
+        Find the missing or unclear fields of the aggregated report, without calling a model.
+
+        The refining agent only runs if fields are missing, and only looks for those fields.
+
+        Args:
+            state (ImageProcessingState): The current state containing the aggregated information
+
+        Returns:
+            ImageProcessingState: Updated state with the missing fields
+    """
+    state["missing_fields"] = find_missing_fields(state["aggregated_info"])
+    print(f"Missing fields of the report: {state['missing_fields'] or 'none'}")
+    return state
+
+def route_after_completeness(state: ImageProcessingState) -> str:
+    """
+        Choose the next node after the completeness check.
+
+        Args:
+            state (ImageProcessingState): The current state containing the missing fields
+
+        Returns:
+            str: "refine_agent" if fields are missing, otherwise "finish_report"
+    """
+    return "refine_agent" if state["missing_fields"] else "finish_report"
+
+def finish_report(state: ImageProcessingState, writer: StreamWriter) -> ImageProcessingState:
     """
         Finalize and polish the report to make it more professional.
         
         This function takes the draft markdown report and uses an LLM to improve
-        its phrasing, formatting, and overall professional tone.
+        its phrasing, formatting, and overall professional tone. The report is
+        streamed, every generated piece is emitted as {"token": ...} on the graph's
+        "custom" stream.
         
         Args:
             state (ImageProcessingState): The current state containing the draft report
+            writer (StreamWriter): Writer of the custom stream, injected by LangGraph
         
         Returns:
             ImageProcessingState: Updated state with the finalized professional report
     """
     llm = LLM()
 
-    system_prompt = f"You are a helpful assistant who finishes an almost done report. Your most important task is to rephrase the report to sound more professional, and follow the correct formatting.\n\nExample finished reports:\n{REPORT_EXAMPLE}"
     user_prompt = f"Rephrase and modify the structure of the following report:\n\n{state['final_report_markdown']}"
 
-    state["final_report_markdown"] = llm.invoke(user_prompt, system_prompt)
+    tokens = []
+    for token in llm.stream(user_prompt, system_prompt(FINISH_INSTRUCTIONS), model=get_profile(state["profile"])["finish_model"]):
+        tokens.append(token)
+        writer({"token": token})
+    state["final_report_markdown"] = "".join(tokens)
 
     return state
 
@@ -0,0 +1,101 @@
+"""
+This module contains the image processing which runs in worker processes: the triage scores and
+the preprocessing of the images.
+
+The workers are started once per process and shared by every run. They are not forked from the
+multi-threaded server process, where a lock held by another thread (e.g. of the HTTP client or the
+scheduler) could stay locked in the child forever, but started by a fork server or spawned. This
+module only imports what the workers need, so they start quickly.
+"""
+
+from PIL import Image, ImageOps
+from concurrent.futures import ProcessPoolExecutor
+from utils.config import PREPROCESS_WORKERS, TRIAGE_SIZE
+
+import io
+import threading
+import multiprocessing
+import numpy as np
+
+_pool = None
+_lock = threading.Lock()
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Return the process pool shared by every run, starting it on first use.
+
+    Returns:
+        ProcessPoolExecutor: The pool with PREPROCESS_WORKERS workers
+    """
+    global _pool
+    with _lock:
+        if _pool is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers=max(1, PREPROCESS_WORKERS), mp_context=multiprocessing.get_context(start_method))
+        return _pool
+
+
+def reset_process_pool() -> None:
+    """
+    Drop a broken process pool (e.g. after a worker was killed), the next run starts a new one.
+    """
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def triage_image(img_path: str) -> tuple[int, float]:
+    """
+    Compute the perceptual hash and the sharpness of an image.
+
+    Args:
+        img_path (str): Path to the image file
+
+    Returns:
+        tuple[int, float]: The 64 bit difference hash and the variance of the Laplacian
+    """
+    with Image.open(img_path) as img:
+        # JPEG images are decoded at a reduced size right away
+        img.draft("L", (TRIAGE_SIZE, TRIAGE_SIZE))
+        img = ImageOps.exif_transpose(img).convert("L")
+        img.thumbnail((TRIAGE_SIZE, TRIAGE_SIZE))
+
+        # Difference hash: is each pixel brighter than its right neighbour, over a 9x8 thumbnail
+        small = np.asarray(img.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+        bits = (small[:, 1:] > small[:, :-1]).flatten()
+        image_hash_value = int("".join("1" if bit else "0" for bit in bits), 2)
+
+        pixels = np.asarray(img, dtype=np.float32)
+        laplacian = pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:] - 4 * pixels[1:-1, 1:-1]
+        return image_hash_value, float(laplacian.var())
+
+
+def preprocess_image(img_path: str, max_dimension: int, image_format: str, quality: int) -> bytes:
+    """
+    Downscale and re-encode a single image without its metadata.
+
+    The EXIF orientation is applied to the pixels before the metadata is dropped,
+    so the image is not rotated after stripping.
+
+    Args:
+        img_path (str): Path to the image file
+        max_dimension (int): Maximum length of the longer side in pixels
+        image_format (str): Output format understood by PIL, e.g. "JPEG" or "WEBP"
+        quality (int): Encoder quality for lossy formats
+
+    Returns:
+        bytes: The encoded image
+    """
+    with Image.open(img_path) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if image_format.upper() in ("JPEG", "JPG") and img.mode != "RGB":
+            img = img.convert("RGB")
+
+        # A fresh image without info is saved, so no EXIF or other metadata is carried over
+        output = io.BytesIO()
+        img.save(output, format=image_format, quality=quality, optimize=True)
+        return output.getvalue()
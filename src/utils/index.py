@@ -0,0 +1,101 @@
+"""
+This module contains the embedding index used to find the images relevant to a question.
+"""
+
+from utils.model import LLM
+
+import re
+import numpy as np
+
+
+class ImageIndex:
+    """
+    A cosine similarity index over the descriptions of the images of a run.
+
+    Each description is split into paragraphs which are embedded separately, an image
+    scores as high as its best matching paragraph.
+    """
+
+    def __init__(self, image_paths: list[str], embeddings: np.ndarray, llm: LLM):
+        """
+        Initialize the index from precomputed embeddings.
+
+        Args:
+            image_paths (list[str]): Image path of each embedded paragraph
+            embeddings (np.ndarray): Embeddings of the paragraphs, one row per paragraph
+            llm (LLM): Used to embed the queries
+        """
+        self.image_paths = image_paths
+        self.llm = llm
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.embeddings = embeddings / np.maximum(norms, 1e-12)
+
+    @classmethod
+    def build(cls, features: list[dict], llm: LLM) -> "ImageIndex":
+        """
+        Embed the image descriptions of a run.
+
+        Args:
+            features (list[dict]): The features of the run, with image_path and extracted_text
+            llm (LLM): Used to embed the descriptions and the queries
+
+        Returns:
+            ImageIndex: The index of the descriptions
+        """
+        image_paths, chunks = [], []
+        for feature in features:
+            for chunk in split_paragraphs(feature["extracted_text"]):
+                image_paths.append(feature["image_path"])
+                chunks.append(chunk)
+
+        embeddings = np.array(llm.embed(chunks), dtype=np.float32) if chunks else np.zeros((0, 1), dtype=np.float32)
+        return cls(image_paths, embeddings, llm)
+
+    def search(self, query: str, k: int) -> list[tuple[str, float]]:
+        """
+        Find the images whose descriptions are most similar to the query.
+
+        Args:
+            query (str): The information to look for
+            k (int): Maximum number of images returned
+
+        Returns:
+            list[tuple[str, float]]: Image paths with their similarity, best first
+        """
+        if not self.image_paths:
+            return []
+
+        query_embedding = np.array(self.llm.embed([query])[0], dtype=np.float32)
+        query_embedding /= max(np.linalg.norm(query_embedding), 1e-12)
+        scores = self.embeddings @ query_embedding
+
+        best_scores = {}
+        for image_path, score in zip(self.image_paths, scores.tolist()):
+            best_scores[image_path] = max(score, best_scores.get(image_path, -1.0))
+
+        return sorted(best_scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+def split_paragraphs(text: str, max_chars: int = 1500) -> list[str]:
+    """
+    Split a description into paragraphs of at most about max_chars characters.
+
+    Args:
+        text (str): The description
+        max_chars (int, optional): Paragraphs are merged up to this length. Defaults to 1500
+
+    Returns:
+        list[str]: The non-empty paragraphs
+    """
+    chunks, current = [], ""
+    for paragraph in re.split(r"\n\s*\n|\n(?=#)", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
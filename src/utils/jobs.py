@@ -0,0 +1,262 @@
+"""
+This module runs the processing graph as background jobs and records the progress events of every job.
+
+A failed job can be retried: the retry is a new job which resumes the run of the failed job from
+its last checkpoint.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from utils.pipeline import get_graph, run_config, can_resume, delete_checkpoints
+from utils.state import ImageProcessingState
+from utils.config import env_int
+from utils.scheduler import llm_priority, PRIORITY_INTERACTIVE
+
+import time
+import uuid
+import threading
+import traceback
+
+
+class JobQueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue of the job manager is full.
+    """
+
+
+class Job:
+    """
+    A single run of the processing graph.
+
+    Every progress event is appended to the events list, readers wait on the
+    condition for new events.
+    """
+
+    def __init__(self, run_id: str, profile: str):
+        self.id = uuid.uuid4().hex
+        self.run_id = run_id
+        self.profile = profile
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at = None
+        self.events = []
+        self.report = None
+        self.error = None
+        self.on_done = None
+        self.condition = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("finished", "failed")
+
+    def add_event(self, event_type: str, status: str | None = None, **data) -> None:
+        """
+        Record a progress event and wake up the readers.
+
+        Args:
+            event_type (str): Type of the event, e.g. "node_started"
+            status (str | None, optional): New status of the job, set together with the event. Defaults to None
+            **data: Additional data of the event
+        """
+        with self.condition:
+            if status is not None:
+                self.status = status
+                if self.done:
+                    self.finished_at = time.time()
+            self.events.append({"type": event_type, "time": time.time(), **data})
+            self.condition.notify_all()
+
+    def to_dict(self) -> dict:
+        """
+        Summarize the job for the status endpoint.
+
+        Returns:
+            dict: The status, the finished nodes, and the report or error if the job is done
+        """
+        with self.condition:
+            return {
+                "job_id": self.id,
+                "run_id": self.run_id,
+                "profile": self.profile,
+                "status": self.status,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+                "finished_nodes": [event["node"] for event in self.events if event["type"] == "node_finished"],
+                "report": self.report,
+                "error": self.error,
+            }
+
+
+class JobManager:
+    """
+    Runs jobs on a bounded thread pool and keeps them for a while after they finish.
+    """
+
+    def __init__(self, max_workers: int, max_queued: int, retention_seconds: float):
+        """
+        Initialize the job manager.
+
+        Args:
+            max_workers (int): Number of graphs run at the same time
+            max_queued (int): Maximum number of unfinished jobs, including the running ones
+            retention_seconds (float): Time after which a finished job is forgotten
+        """
+        self.max_queued = max_queued
+        self.retention_seconds = retention_seconds
+        self.jobs = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+
+    def submit(self, state: ImageProcessingState, on_done=None, priority: int = PRIORITY_INTERACTIVE) -> Job:
+        """
+        Queue a run of the processing graph.
+
+        Args:
+            state (ImageProcessingState): The initial state of the run
+            on_done (Callable[[], None] | None, optional): Called when the job is finished, e.g. to
+                remove its uploaded images. For a failed job it is called when the job is forgotten,
+                so a retry can still use the images. Defaults to None
+            priority (int, optional): Priority of the job's LLM requests. Defaults to PRIORITY_INTERACTIVE
+
+        Returns:
+            Job: The queued job
+
+        Raises:
+            JobQueueFullError: If there are already max_queued unfinished jobs
+        """
+        job = Job(state["run_id"], state["profile"])
+        self._enqueue(job, state, on_done, priority)
+        return job
+
+    def retry(self, job_id: str, priority: int = PRIORITY_INTERACTIVE) -> Job:
+        """
+        Queue a new job which resumes the run of a failed job from its last completed node.
+
+        Args:
+            job_id (str): ID of the failed job
+            priority (int, optional): Priority of the job's LLM requests. Defaults to PRIORITY_INTERACTIVE
+
+        Returns:
+            Job: The queued job
+
+        Raises:
+            KeyError: If the job does not exist (anymore)
+            ValueError: If the job did not fail or its run cannot be resumed
+            JobQueueFullError: If there are already max_queued unfinished jobs
+        """
+        failed = self.get(job_id)
+        if failed is None:
+            raise KeyError(f"Unknown job {job_id}")
+        if failed.status != "failed" or not can_resume(failed.run_id):
+            raise ValueError("Only a failed job with a stored checkpoint can be retried")
+
+        job = Job(failed.run_id, failed.profile)
+        self._enqueue(job, None, failed.on_done, priority)
+        # The cleanup of the images moves to the retry
+        failed.on_done = None
+        return job
+
+    def _enqueue(self, job: Job, state: ImageProcessingState | None, on_done, priority: int) -> None:
+        job.on_done = on_done
+        with self._lock:
+            self._prune()
+            if sum(not queued.done for queued in self.jobs.values()) >= self.max_queued:
+                raise JobQueueFullError("Too many jobs in progress, try again later")
+            self.jobs[job.id] = job
+
+        self._executor.submit(self._run, job, state, priority)
+
+    def get(self, job_id: str) -> Job | None:
+        """
+        Look up a job by its ID.
+
+        Args:
+            job_id (str): ID of the job
+
+        Returns:
+            Job | None: The job, or None if it does not exist (anymore)
+        """
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def events(self, job: Job, heartbeat_seconds: float = 15):
+        """
+        Iterate over the events of a job, waiting for new ones until the job is done.
+
+        None is yielded when no event arrived for heartbeat_seconds, so the caller can keep
+        the connection alive.
+
+        Args:
+            job (Job): The job to follow
+            heartbeat_seconds (float, optional): Maximum time to wait for an event. Defaults to 15
+
+        Yields:
+            dict | None: The next event, or None as a heartbeat
+        """
+        index = 0
+        while True:
+            with job.condition:
+                if index >= len(job.events) and not job.done:
+                    job.condition.wait(timeout=heartbeat_seconds)
+                new_events = job.events[index:]
+                done = job.done
+            index += len(new_events)
+
+            if not new_events:
+                if done:
+                    return
+                yield None
+            for event in new_events:
+                yield event
+
+    def _run(self, job: Job, state: ImageProcessingState | None, priority: int = PRIORITY_INTERACTIVE) -> None:
+        try:
+            with llm_priority(priority):
+                self._run_graph(job, state)
+        finally:
+            # The images of a failed job are kept for a retry until the job is forgotten
+            if job.status != "failed" and job.on_done is not None:
+                job.on_done()
+                job.on_done = None
+
+    def _run_graph(self, job: Job, state: ImageProcessingState | None) -> None:
+        # Without a state, the run is resumed from its last checkpoint
+        job.add_event("job_started", status="running", resumed=state is None)
+
+        final_state = None
+        try:
+            for mode, chunk in get_graph(job.profile).stream(state, run_config(job.run_id), stream_mode=["debug", "values", "custom"]):
+                if mode == "values":
+                    final_state = chunk
+                elif mode == "custom":
+                    if "token" in chunk:
+                        job.add_event("token", text=chunk["token"])
+                elif chunk["type"] == "task":
+                    job.add_event("node_started", node=chunk["payload"]["name"])
+                elif chunk["type"] == "task_result":
+                    job.add_event("node_finished", node=chunk["payload"]["name"])
+
+            job.report = final_state["final_report_markdown"]
+            delete_checkpoints(job.run_id)
+            job.add_event("job_finished", status="finished", report=job.report)
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.add_event("job_failed", status="failed", error=job.error)
+
+    def _prune(self) -> None:
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.done and now - job.finished_at > self.retention_seconds:
+                del self.jobs[job_id]
+                if job.on_done is not None:
+                    job.on_done()
+                # A failed run which was not retried cannot be resumed anymore, a retry keeps the checkpoints
+                if job.status == "failed" and all(other.run_id != job.run_id for other in self.jobs.values()):
+                    delete_checkpoints(job.run_id)
+
+
+job_manager = JobManager(
+    max_workers=env_int("JOB_WORKERS", 4),
+    max_queued=env_int("JOB_QUEUE_SIZE", 32),
+    retention_seconds=env_int("JOB_RETENTION_SECONDS", 3600),
+)
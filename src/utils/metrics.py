@@ -0,0 +1,111 @@
+"""
+This module defines the Prometheus metrics of the pipeline and the helpers which record them.
+"""
+
+from prometheus_client import Counter, Histogram
+from langchain_core.runnables import Runnable
+
+import time
+import functools
+
+NODE_SECONDS = Histogram(
+    "pipeline_node_duration_seconds", "Wall time of a graph node",
+    ["node"], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, 300, 600),
+)
+NODE_FAILURES = Counter("pipeline_node_failures_total", "Graph node runs which raised an error", ["node"])
+
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_duration_seconds", "Wall time of an OpenAI request, retries included",
+    ["operation", "model"], buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+LLM_QUEUE_SECONDS = Histogram(
+    "llm_queue_wait_seconds", "Time an OpenAI request waited for the rate limits",
+    ["model"], buckets=(0, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60),
+)
+LLM_RETRIES = Counter("llm_retries_total", "Retried OpenAI requests", ["model"])
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens used by OpenAI requests", ["operation", "model", "kind"])
+LLM_CACHED_RATIO = Histogram(
+    "llm_prompt_cached_ratio", "Share of the input tokens of an OpenAI request served from the prompt cache",
+    ["operation", "model"], buckets=(0, 0.1, 0.25, 0.5, 0.75, 0.9, 1),
+)
+LLM_COST = Counter("llm_cost_dollars_total", "Estimated cost of OpenAI requests in USD", ["model"])
+
+UPLOAD_BYTES = Counter("upload_bytes_total", "Image bytes uploaded to OpenAI, and bytes not uploaded thanks to reuse", ["result"])
+TOOL_CALLS = Counter("agent_tool_calls_total", "Tool calls of the refining agent", ["tool"])
+TOOL_MEMO_HITS = Counter("agent_tool_memo_hits_total", "Tool calls answered from the memo of the run", ["tool"])
+
+# USD per million input and output tokens
+PRICES = {
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4o-mini": (0.15, 0.60),
+    "o3": (2.00, 8.00),
+    "o4-mini": (1.10, 4.40),
+    "o3-mini": (1.10, 4.40),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+# Cached input tokens are billed at a quarter of the input price
+CACHED_INPUT_FACTOR = 0.25
+
+
+def record_usage(operation: str, model: str, usage) -> None:
+    """
+    Record the tokens and the cost of an OpenAI response.
+
+    Args:
+        operation (str): Name of the LLM method, e.g. "describe_image"
+        model (str): The model of the request
+        usage: The usage object of the response, None if unknown
+    """
+    if usage is None:
+        return
+
+    # The chat completions and embeddings APIs report prompt/completion tokens, the responses API input/output tokens
+    input_tokens = getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", None) or 0
+    output_tokens = getattr(usage, "completion_tokens", None) or getattr(usage, "output_tokens", None) or 0
+    details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    LLM_TOKENS.labels(operation, model, "input").inc(input_tokens)
+    LLM_TOKENS.labels(operation, model, "cached_input").inc(cached_tokens)
+    LLM_TOKENS.labels(operation, model, "output").inc(output_tokens)
+    if input_tokens:
+        LLM_CACHED_RATIO.labels(operation, model).observe(cached_tokens / input_tokens)
+
+    input_price, output_price = PRICES.get(model, (0.0, 0.0))
+    billed_input = input_tokens - cached_tokens + cached_tokens * CACHED_INPUT_FACTOR
+    LLM_COST.labels(model).inc((billed_input * input_price + output_tokens * output_price) / 1e6)
+
+
+def instrument_node(name: str, node):
+    """
+    Wrap a graph node so that its wall time and failures are recorded.
+
+    The wrapper keeps the signature of the node, so LangGraph still injects the config and
+    the stream writer.
+
+    Args:
+        name (str): Name of the node in the graph
+        node (Callable | Runnable): The node function or runnable
+
+    Returns:
+        Callable: The instrumented node
+    """
+    if isinstance(node, Runnable):
+        def call(state, config):
+            return node.invoke(state, config)
+    else:
+        call = node
+
+    @functools.wraps(call)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return call(*args, **kwargs)
+        except Exception:
+            NODE_FAILURES.labels(name).inc()
+            raise
+        finally:
+            NODE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+    return wrapper
@@ -1,6 +1,17 @@
-from openai import OpenAI
-from utils.examples import OUTPUT_FORMAT
-    
+from utils.clients import get_client
+from utils.examples import OUTPUT_FORMAT, REGION_FORMAT
+from utils.cache import description_cache, content_hash
+from utils.files import file_registry
+from utils.scheduler import scheduler, estimate_tokens
+from utils.metrics import record_usage
+from utils.regions import crop_cache
+
+import os
+import json
+
+# Bump this whenever the describe_image prompt changes, so cached descriptions are not reused
+DESCRIPTION_PROMPT_VERSION = "1"
+
 class LLM:
     """
     A wrapper class for OpenAI API interactions that handles various LLM operations.
@@ -8,31 +19,33 @@ class LLM:
     This class provides methods for interacting with OpenAI models, including
     text generation, image analysis, and structured report creation. It abstracts
     away the details of API calls and provides a simple interface for the rest
-    of the application.
+    of the application. Every request goes through the rate limiting scheduler.
     """
     
     def __init__(self):
         """
-        Initialize the LLM class with an OpenAI client.
+        Initialize the LLM class with the shared OpenAI client of the process.
         """
-        self.client = OpenAI()
+        self.client = get_client()
         
-    def create_file(self, file_path):
+    def create_file(self, file_path, data: bytes | None = None):
         """
         Upload a file to OpenAI for vision-based processing.
+
+        The upload is skipped if the same content was already uploaded by this process,
+        in which case the registered file ID is reused.
         
         Args:
             file_path (str): Path to the image file to be uploaded
+            data (bytes | None, optional): Preprocessed content to upload instead of the file on disk. Defaults to None
             
         Returns:
             str: The file ID assigned by OpenAI, used for subsequent API calls
         """
-        with open(file_path, "rb") as file_content:
-            result = self.client.files.create(
-                file=file_content,
-                purpose="vision",
-            )
-            return result.id
+        if data is None:
+            with open(file_path, "rb") as file_content:
+                data = file_content.read()
+        return file_registry.get_or_upload(self.client, data, os.path.basename(file_path))
         
     def invoke(self, user_prompt: str, system_prompt: str, model: str = "gpt-4o-mini"):
         """
@@ -49,7 +62,7 @@ class LLM:
         Returns:
             str: The generated text response from the model
         """
-        resp = self.client.chat.completions.create(
+        resp = scheduler.run(model, estimate_tokens(user_prompt, system_prompt), lambda: self.client.chat.completions.create(
             model = model,
             messages = [
                 {
@@ -61,31 +74,100 @@ class LLM:
                     "content": user_prompt
                 }
             ]
-        )
+        ), operation="invoke")
 
         return resp.choices[0].message.content
         
-    def describe_image(self, img_path: str, additional_info: str | None = None, model: str = "gpt-4.1-mini") -> str:
+    def stream(self, user_prompt: str, system_prompt: str, model: str = "gpt-4o-mini"):
+        """
+        Generate a text response like invoke(), but yield it in pieces as it is generated.
+        
+        Args:
+            user_prompt (str): The prompt text from the user's perspective
+            system_prompt (str): Instructions for the model about its role and task
+            model (str, optional): The OpenAI model to use. Defaults to "gpt-4o-mini"
+            
+        Yields:
+            str: The next piece of the generated text response
+        """
+        # Only opening the stream is retried, a failure after the first piece is raised
+        estimated_tokens = estimate_tokens(user_prompt, system_prompt)
+        resp = scheduler.run(model, estimated_tokens, lambda: self.client.chat.completions.create(
+            model = model,
+            messages = [
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": user_prompt
+                }
+            ],
+            stream=True,
+            stream_options={"include_usage": True},
+        ), operation="stream")
+
+        for chunk in resp:
+            if chunk.usage is not None:
+                scheduler.correct(model, estimated_tokens, chunk.usage.total_tokens)
+                record_usage("stream", model, chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def embed(self, texts: list[str], model: str = "text-embedding-3-small") -> list[list[float]]:
+        """
+        Create embeddings of the given texts using the OpenAI embeddings API.
+        
+        Args:
+            texts (list[str]): The texts to embed
+            model (str, optional): The OpenAI embedding model to use. Defaults to "text-embedding-3-small"
+            
+        Returns:
+            list[list[float]]: One embedding per text, in the same order
+        """
+        # Embeddings have no output tokens
+        resp = scheduler.run(model, sum(len(text) for text in texts) // 4, lambda: self.client.embeddings.create(model=model, input=texts), operation="embed")
+        return [item.embedding for item in sorted(resp.data, key=lambda item: item.index)]
+
+    def describe_image(self, img_path: str, additional_info: str | None = None, model: str = "gpt-4.1-mini", use_cache: bool = True, image_data: bytes | None = None) -> str:
         """
         Generate a descriptive text of an image using OpenAI's vision capabilities.
         
         This method uploads an image, sends it to the vision model with a prompt
         to describe the image, and returns the generated description. It can incorporate
         additional context from previous image descriptions.
+
+        Descriptions are cached on disk, keyed by the image content, the model, the prompt
+        version and the additional context, so a repeated image costs no API call.
         
         Args:
             img_path (str): Path to the image file to be described
             additional_info (str | None, optional): Additional context from previous images. Defaults to None
             model (str, optional): The OpenAI vision model to use. Defaults to "gpt-4.1-mini"
+            use_cache (bool, optional): Whether to use the description cache. Defaults to True
+            image_data (bytes | None, optional): Preprocessed image content to use instead of the file. Defaults to None
             
         Returns:
             str: The generated description of the image
         """
-        file_id = self.create_file(img_path)
+        additional_info = additional_info or ""
+
+        if image_data is None:
+            with open(img_path, "rb") as f:
+                image_data = f.read()
+
+        if use_cache:
+            cache_key = content_hash(image_data, model, DESCRIPTION_PROMPT_VERSION, additional_info)
+            cached = description_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        file_id = self.create_file(img_path, image_data)
         additional_info_text = 'This is additional information generated from other images of the same object: ' + additional_info + '\nOnly include the new information in the description, and not the information from the previous images.' if additional_info != "" else ""
         prompt = f"Describe this image. You are analyzing an image to be included as collateral. Focus on the condition, brand, and specifications of the item. {additional_info_text}"
 
-        response = self.client.responses.create(
+        response = scheduler.run(model, estimate_tokens(prompt, images=1), lambda: self.client.responses.create(
             model=model,
             input=[{
                 "role": "user",
@@ -97,33 +179,104 @@ class LLM:
                     },
                 ],
             }],
-        )
+        ), operation="describe_image")
+
+        if use_cache:
+            description_cache.set(cache_key, response.output_text)
 
         return response.output_text
     
-    def find_information(self, img_path: str, information: str, additional_info: str | None = None, model: str = "gpt-4.1-mini") -> str:
+    def locate_region(self, img_path: str, information: str, model: str = "gpt-4.1-mini", image_data: bytes | None = None) -> tuple[bool, list[float] | None]:
+        """
+        Find the region of an image which shows specific information, on a low detail overview of the image.
+
+        Args:
+            img_path (str): Path to the image file to analyze
+            information (str): Description of the specific information to find
+            model (str, optional): The OpenAI vision model to use. Defaults to "gpt-4.1-mini"
+            image_data (bytes | None, optional): Preprocessed image content to use instead of the file. Defaults to None
+
+        Returns:
+            tuple[bool, list[float] | None]: False if the information is not visible in the image, and the left,
+                                             top, right and bottom of the region as fractions of the image size,
+                                             or None if the answer is not a valid box
+        """
+        file_id = self.create_file(img_path, image_data)
+
+        prompt = f"You are analyzing an image to be included as collateral. Find the region of the image which shows this information: {information}\n\nReturn the bounding box of the region as left, top, right and bottom edge, each as a fraction between 0 and 1 of the image width or height. The image is shown at a low resolution: if a part of the image could show the information, for example a label or a plate which is too small to read, return its region. Set found to false only if no part of the image can show the information."
+
+        response = scheduler.run(model, estimate_tokens(prompt, images=1), lambda: self.client.responses.create(
+            model=model,
+            input=[{
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": prompt},
+                    {
+                        "type": "input_image",
+                        "file_id": file_id,
+                        "detail": "low",
+                    },
+                ],
+            }],
+            text={"format": REGION_FORMAT},
+        ), operation="locate_region")
+
+        try:
+            region = json.loads(response.output_text)
+        except ValueError:
+            return True, None
+        if not isinstance(region, dict):
+            return True, None
+        if region.get("found") is False:
+            return False, None
+        try:
+            left, top, right, bottom = (float(value) for value in region["box"])
+        except (ValueError, TypeError, KeyError):
+            return True, None
+        if not (0 <= left < right <= 1 and 0 <= top < bottom <= 1):
+            return True, None
+        return True, [left, top, right, bottom]
+
+    def find_information(self, img_path: str, information: str, additional_info: str | None = None, model: str = "gpt-4.1-mini", image_data: bytes | None = None, two_pass: bool = False) -> str:
         """
         Extract specific information from an image using OpenAI's vision capabilities.
         
         This method uploads an image, sends it to the vision model with a prompt
         to find specific information in the image, and returns the extracted information.
+        In two pass mode the region which shows the information is located first, and only a
+        high resolution crop of that region is read. If the information is not visible at all,
+        the answer is given without a second request. If the region is not a valid box, or it
+        cannot be cropped, the whole image is read.
         
         Args:
             img_path (str): Path to the image file to analyze
             information (str): Description of the specific information to extract
             additional_info (str | None, optional): Additional context from previous analyses. Defaults to None
             model (str, optional): The OpenAI vision model to use. Defaults to "gpt-4.1-mini"
+            image_data (bytes | None, optional): Preprocessed image content to use instead of the file. Defaults to None
+            two_pass (bool, optional): Locate the region of the information before reading it. Defaults to False
             
         Returns:
-            str: The extracted information from the image
+            str: The extracted information from the image, ending with a "Confidence: <0-1>" line
         """
-        file_id = self.create_file(img_path)
+        crop_note, detail = "", "auto"
+        if two_pass:
+            found, box = self.locate_region(img_path, information, model, image_data)
+            if not found:
+                # Most of the selected images do not show the information, they cost a single low detail request
+                return f"The requested information ({information}) is not visible in this image.\nConfidence: 0"
+            crop = crop_cache.get_crop(img_path, image_data, box) if box is not None else None
+            if crop is not None:
+                image_data, detail = crop, "high"
+                crop_note = "The image is a crop of the region of the original image which shows the information.\n\n"
+
+        file_id = self.create_file(img_path, image_data)
 
         additional_info_text = 'This is additional description generated from other images related to the same information: ' + additional_info + "\nYou can disregard this if it is not relevant, or doesn't contain the information you need." if additional_info != "" else ""
-        prompt = f"Describe this image. You are analyzing an image to be included as collateral. You need to find this information in the image: {information}\n\n{additional_info_text}"
+        prompt = f"Describe this image. You are analyzing an image to be included as collateral. You need to find this information in the image: {information}\n\n{crop_note}{additional_info_text}\n\nEnd your answer with a line 'Confidence: <number between 0 and 1>' stating how certain you are that the image fully answers the requested information."
 
-        response = self.client.responses.create(
-            model="gpt-4.1-mini",
+        response = scheduler.run(model, estimate_tokens(prompt, images=1), lambda: self.client.responses.create(
+            model=model,
             input=[{
                 "role": "user",
                 "content": [
@@ -131,10 +284,11 @@ class LLM:
                     {
                         "type": "input_image",
                         "file_id": file_id,
+                        "detail": detail,
                     },
                 ],
             }],
-        )
+        ), operation="find_information")
 
         return response.output_text
     
@@ -153,7 +307,7 @@ class LLM:
         Returns:
             str: The generated report in the specified format (typically JSON)
         """
-        resp = self.client.chat.completions.create(
+        resp = scheduler.run(model, estimate_tokens(user_prompt, system_prompt), lambda: self.client.chat.completions.create(
             model = model,
             messages = [
                 {
@@ -166,6 +320,6 @@ class LLM:
                 }
             ],
             response_format=OUTPUT_FORMAT,
-        )
+        ), operation="create_report")
 
         return resp.choices[0].message.content
\ No newline at end of file
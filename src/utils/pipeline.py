@@ -0,0 +1,224 @@
+"""
+This module builds the processing graph. The graph and the refining agent are compiled once per process and shared by every request, only the state is created per request.
+
+The graph is compiled with a SQLite checkpointer, which stores the state after every node under
+the run ID. A failed run can be resumed from its last completed node instead of starting over.
+
+Every pipeline profile (see utils/profiles.py) has its own compiled graph and refining agent.
+"""
+
+from langgraph.graph import StateGraph, START, END
+from langgraph.graph.state import CompiledStateGraph
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.sqlite import SqliteSaver
+from utils.helpers import load_images, preprocess_images, describe_images, merge_features, aggregate_info, write_report, check_completeness, route_after_completeness, finish_report
+from utils.profiles import PROFILES, DEFAULT_PROFILE, get_profile
+from utils.state import ImageProcessingState
+from utils.agent import RefiningAgent
+from utils.metrics import instrument_node
+from utils.run_context import delete_workspace, workspace_path
+
+import os
+import uuid
+import sqlite3
+import threading
+
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", os.path.join(os.getcwd(), "data", "checkpoints", "checkpoints.sqlite"))
+
+_graphs = {}
+_refining_agents = {}
+_checkpointer = None
+_lock = threading.Lock()
+
+
+def create_default_state(images_dir: str, run_id: str | None = None, case_id: str | None = None, profile: str | None = None) -> ImageProcessingState:
+    """
+    Create a default ImageProcessingState with initial values.
+
+    Args:
+        images_dir (str): The directory containing the images.
+        run_id (str | None): ID of the run. A new random ID is used if not given.
+        case_id (str | None): ID of the case, enables the reuse of the case's earlier results.
+        profile (str | None): Name of the pipeline profile. DEFAULT_PROFILE is used if not given.
+
+    Returns:
+        ImageProcessingState: A state object with default values.
+    """
+    return {
+        "run_id": run_id or uuid.uuid4().hex,
+        "case_id": case_id,
+        "profile": profile or DEFAULT_PROFILE,
+        "images_dir": images_dir,
+        "image_names": [],
+        "image_paths": [],
+        "image_hashes": {},
+        "image_groups": {},
+        "features": [],
+        "aggregated_info": "",
+        "missing_fields": [],
+        "final_report_markdown": "",
+        "messages": []
+    }
+
+
+def run_config(run_id: str) -> dict:
+    """
+    Create the config of a graph run. The checkpoints of the run are stored under its run ID.
+
+    Args:
+        run_id (str): ID of the run
+
+    Returns:
+        dict: The config to pass to invoke() or stream()
+    """
+    return {"configurable": {"thread_id": run_id}}
+
+
+def build_graph(refining_agent: RefiningAgent, checkpointer: BaseCheckpointSaver | None = None, profile: str | None = None) -> CompiledStateGraph:
+    """
+    Build and compile the processing graph.
+
+    Args:
+        refining_agent (RefiningAgent): The agent used by the refine_agent node
+        checkpointer (BaseCheckpointSaver | None, optional): Stores the state after every node. Defaults to None
+        profile (str | None, optional): The pipeline profile which decides the shape of the graph. Defaults to DEFAULT_PROFILE
+
+    Returns:
+        CompiledStateGraph: The compiled graph
+    """
+    options = get_profile(profile)
+    graph_builder = StateGraph(ImageProcessingState)
+
+    # Define the basic data processing nodes, their wall time is recorded in the metrics
+    graph_builder.add_node("load_images", instrument_node("load_images", load_images))
+    graph_builder.add_node("preprocess_images", instrument_node("preprocess_images", preprocess_images))
+    graph_builder.add_node("extract_text_vision_model", instrument_node("extract_text_vision_model", describe_images))
+    graph_builder.add_node("merge_features", instrument_node("merge_features", merge_features))
+
+    # Define the main flow
+    graph_builder.add_edge(START, "load_images")
+    graph_builder.add_edge("load_images", "preprocess_images")
+    graph_builder.add_edge("preprocess_images", "extract_text_vision_model")
+    graph_builder.add_edge("extract_text_vision_model", "merge_features")
+
+    if options["single_pass_report"]:
+        # One structured call writes the finished report, there is no refinement
+        graph_builder.add_node("write_report", instrument_node("write_report", write_report))
+        graph_builder.add_edge("merge_features", "write_report")
+        graph_builder.add_edge("write_report", END)
+        return graph_builder.compile(checkpointer=checkpointer)
+
+    graph_builder.add_node("aggregate_info", instrument_node("aggregate_info", aggregate_info))
+    graph_builder.add_node("finish_report", instrument_node("finish_report", finish_report))
+    graph_builder.add_edge("merge_features", "aggregate_info")
+
+    if options["refine"]:
+        graph_builder.add_node("check_completeness", instrument_node("check_completeness", check_completeness))
+        graph_builder.add_node("refine_agent", instrument_node("refine_agent", refining_agent))
+        graph_builder.add_edge("aggregate_info", "check_completeness")
+        # The agent is skipped if the aggregated report has no missing fields
+        graph_builder.add_conditional_edges("check_completeness", route_after_completeness, ["refine_agent", "finish_report"])
+        graph_builder.add_edge("refine_agent", "finish_report")
+    else:
+        graph_builder.add_edge("aggregate_info", "finish_report")
+    graph_builder.add_edge("finish_report", END)
+
+    # Compile the graph
+    return graph_builder.compile(checkpointer=checkpointer)
+
+
+def get_graph(profile: str | None = None) -> CompiledStateGraph:
+    """
+    Return the shared compiled graph of a pipeline profile, building it on first use.
+
+    The compiled graph keeps no per-run data, so it can be invoked from several threads at once.
+
+    Args:
+        profile (str | None, optional): Name of the pipeline profile. Defaults to DEFAULT_PROFILE
+
+    Returns:
+        CompiledStateGraph: The compiled graph
+
+    Raises:
+        KeyError: If there is no profile with that name
+    """
+    profile = profile or DEFAULT_PROFILE
+    if profile not in _graphs:
+        with _lock:
+            if profile not in _graphs:
+                _refining_agents[profile] = RefiningAgent(get_profile(profile)["agent_model"])
+                _graphs[profile] = build_graph(_refining_agents[profile], get_checkpointer(), profile)
+    return _graphs[profile]
+
+
+def get_checkpointer() -> SqliteSaver:
+    """
+    Return the checkpointer shared by every run of this process, creating its database on first use.
+
+    Returns:
+        SqliteSaver: The checkpointer
+    """
+    global _checkpointer
+    if _checkpointer is None:
+        os.makedirs(os.path.dirname(CHECKPOINT_DB), exist_ok=True)
+        # The saver serializes the access of the threads to the connection
+        _checkpointer = SqliteSaver(sqlite3.connect(CHECKPOINT_DB, check_same_thread=False))
+    return _checkpointer
+
+
+def run_profile(run_id: str) -> str | None:
+    """
+    Return the pipeline profile of a checkpointed run.
+
+    Args:
+        run_id (str): ID of the run
+
+    Returns:
+        str | None: Name of the profile, or None if the run has no checkpoint
+    """
+    return get_graph().get_state(run_config(run_id)).values.get("profile")
+
+
+def can_resume(run_id: str) -> bool:
+    """
+    Check whether a run stopped before its end and can be resumed from its last checkpoint.
+
+    Args:
+        run_id (str): ID of the run
+
+    Returns:
+        bool: True if the run has a checkpoint with nodes left to run and the preprocessed
+              images of the checkpoint are still in its workspace
+    """
+    profile = run_profile(run_id)
+    if profile not in PROFILES:
+        return False
+    snapshot = get_graph(profile).get_state(run_config(run_id))
+    # The checkpoint only holds the hashes of the images, a workspace which was lost
+    # (e.g. with a fresh container) cannot be resumed and the run has to start over
+    images_dir = os.path.join(workspace_path(run_id), "images")
+    image_hashes = snapshot.values.get("image_hashes", {})
+    return bool(snapshot.next) and all(os.path.exists(os.path.join(images_dir, image_hash)) for image_hash in image_hashes.values())
+
+
+def delete_checkpoints(run_id: str) -> None:
+    """
+    Remove the checkpoints and the workspace of a finished run, they are only needed to resume failed runs.
+
+    Args:
+        run_id (str): ID of the run
+    """
+    get_checkpointer().delete_thread(run_id)
+    delete_workspace(run_id)
+
+
+def warm_up() -> None:
+    """
+    Build the graphs of every profile, and the refining agents of the profiles which refine, ahead of the first request.
+    """
+    for profile, options in PROFILES.items():
+        get_graph(profile)
+        # The graph of a profile without refinement has no agent node
+        if options["refine"]:
+            _refining_agents[profile].get_agent()
+    print("Pipeline is ready.")
@@ -0,0 +1,74 @@
+"""
+This module defines the pipeline profiles, which trade report quality for latency and cost per request.
+
+A profile sets the model of every stage and the shape of the graph:
+    - "fast" writes the finished report in a single structured call after the image descriptions
+      and skips the refinement,
+    - "standard" runs every stage with the models the pipeline was built with,
+    - "thorough" uses the larger models for the vision and reasoning stages.
+The models of a profile can be overridden with the PIPELINE_PROFILES environment variable, e.g.
+PIPELINE_PROFILES={"fast": {"describe_model": "gpt-4.1-nano"}}.
+"""
+
+from dotenv import load_dotenv
+
+import os
+import json
+
+# The frontend reads the profiles too, without importing utils.config
+load_dotenv()
+
+PROFILES = {
+    "fast": {
+        "describe_model": "gpt-4.1-mini",
+        "find_model": "gpt-4.1-mini",
+        "tool_model": "gpt-4o-mini",
+        "aggregate_model": "gpt-4.1-mini",
+        "agent_model": "o3-mini",
+        "finish_model": "gpt-4o-mini",
+        # aggregate_info and finish_report are replaced by one structured call, without refinement
+        "single_pass_report": True,
+        "refine": False,
+    },
+    "standard": {
+        "describe_model": "gpt-4.1-mini",
+        "find_model": "gpt-4.1-mini",
+        "tool_model": "gpt-4o-mini",
+        "aggregate_model": "o4-mini",
+        "agent_model": "o3-mini",
+        "finish_model": "gpt-4o-mini",
+        "single_pass_report": False,
+        "refine": True,
+    },
+    "thorough": {
+        "describe_model": "gpt-4.1",
+        "find_model": "gpt-4.1",
+        "tool_model": "gpt-4.1-mini",
+        "aggregate_model": "o3",
+        "agent_model": "o4-mini",
+        "finish_model": "gpt-4.1-mini",
+        "single_pass_report": False,
+        "refine": True,
+    },
+}
+
+for _name, _overrides in json.loads(os.getenv("PIPELINE_PROFILES", "{}")).items():
+    PROFILES.setdefault(_name, dict(PROFILES["standard"])).update(_overrides)
+
+DEFAULT_PROFILE = os.getenv("PIPELINE_PROFILE", "standard")
+
+
+def get_profile(name: str | None = None) -> dict:
+    """
+    Look up a pipeline profile.
+
+    Args:
+        name (str | None, optional): Name of the profile. Defaults to DEFAULT_PROFILE
+
+    Returns:
+        dict: The models and graph options of the profile
+
+    Raises:
+        KeyError: If there is no profile with that name
+    """
+    return PROFILES[name or DEFAULT_PROFILE]
@@ -0,0 +1,95 @@
+"""
+This module assembles the prompts of the pipeline so that the provider's prompt prefix cache can be used.
+
+Every stage's system prompt starts with the same byte-identical SHARED_CONTEXT (which contains the
+long report examples), followed by the stage's static instructions. Everything which changes per
+request is put in the user message, after the static part. The variable text can be trimmed to a
+token budget.
+"""
+
+from utils.examples import REPORT_EXAMPLE
+from utils.config import env_int
+from utils.scheduler import text_tokens, CHARS_PER_TOKEN
+
+PROMPT_TOKEN_BUDGET = env_int("PROMPT_TOKEN_BUDGET", 60000)
+
+SHARED_CONTEXT = f"""You are part of a system which writes reports about objects used as collateral, based on images of the object.
+
+These are examples of complete, finished reports:
+{REPORT_EXAMPLE}"""
+
+AGGREGATE_INSTRUCTIONS = """Your task: you receive descriptions of multiple images of one object used as collateral and create a report from them. A lot of images can focus on a certain part of an object, for example the tire of a car. Always focus on the object as a whole and not on a specific part in the report.
+
+If you are unclear about an importart detail, indicate it in the report."""
+
+REFINE_INSTRUCTIONS = """Your task: you are helping to refine a report about an object used as collateral. You need to identify parts of the report which contain missing or incomplete information and augment it by looking at images of the object. After identifying missing information, you should look for the relevant images and analyze them to find the missing information.
+
+You have access to the following tools:
+- select_relevant_images
+- analyze_images
+- ddg_search
+
+Always use tools to refine the report. If you use the ddg_search, indicate that the information is from a web search.
+Tool calls which do not depend on each other should be made in the same step, they are run at the same time. Do not repeat a tool call with the same arguments.
+
+Use the following format:
+
+Question: the report which you need to refine
+Thought: you should always think about what to do
+Action: the action to take should be one of the following: select_relevant_images, analyze_images, ddg_search
+Action Input: the input to the action
+Observation: the result of the action
+... (this Thought/Action/Action Input/Observation can repeat N times)
+Thought: I now know the final answer
+Final Answer: ONLY the modified final report in markdown format, without the level 3 headers (###)"""
+
+SINGLE_PASS_INSTRUCTIONS = """Your task: you receive descriptions of multiple images of one object used as collateral and create a finished report from them. A lot of images can focus on a certain part of an object, for example the tire of a car. Always focus on the object as a whole and not on a specific part in the report.
+
+The report must sound professional and follow the formatting of the example reports. If you are unclear about an importart detail, indicate it in the report."""
+
+FINISH_INSTRUCTIONS = """Your task: you receive an almost done report and finish it. Your most important task is to rephrase the report to sound more professional, and follow the correct formatting of the example reports."""
+
+
+def system_prompt(instructions: str) -> str:
+    """
+    Create the system prompt of a stage: the shared context followed by the stage's instructions.
+
+    Args:
+        instructions (str): Static instructions of the stage. Must not contain per-request text.
+
+    Returns:
+        str: The system prompt
+    """
+    return f"{SHARED_CONTEXT}\n\n{instructions.strip()}"
+
+
+def fit_to_budget(texts: list[str], budget_tokens: int = PROMPT_TOKEN_BUDGET) -> list[str]:
+    """
+    Trim texts so that together they fit into a token budget.
+
+    Texts shorter than an equal share of the budget are kept whole, the remaining budget is
+    divided evenly among the longer texts, which are cut at a line boundary.
+
+    Args:
+        texts (list[str]): The texts, e.g. the image descriptions
+        budget_tokens (int, optional): The token budget of all texts. Defaults to PROMPT_TOKEN_BUDGET
+
+    Returns:
+        list[str]: The texts, trimmed where needed
+    """
+    if sum(text_tokens(text) for text in texts) <= budget_tokens:
+        return texts
+
+    # Find the share each long text gets once the short texts are kept whole
+    remaining_budget, long_texts = budget_tokens, sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    while long_texts and text_tokens(texts[long_texts[0]]) <= remaining_budget // len(long_texts):
+        remaining_budget -= text_tokens(texts[long_texts.pop(0)])
+    share_chars = remaining_budget // max(1, len(long_texts)) * CHARS_PER_TOKEN
+
+    trimmed = list(texts)
+    for i in long_texts:
+        cut = texts[i][:share_chars]
+        if "\n" in cut:
+            cut = cut[:cut.rindex("\n")]
+        trimmed[i] = f"{cut}\n[...]"
+    return trimmed
@@ -0,0 +1,130 @@
+"""
+This module crops the region of an image which shows a specific piece of information.
+
+The crops are cut from the original, full resolution image and kept in a small in-memory cache
+per image and region, so the repeated questions of the refining agent do not decode and encode
+the same image again.
+"""
+
+from PIL import Image, ImageOps
+from utils.cache import content_hash
+from utils.config import PREPROCESS_MAX_DIMENSION, PREPROCESS_FORMAT, PREPROCESS_QUALITY, CROP_PADDING, MAX_CROP_AREA, CROP_CACHE_ENTRIES, CROP_CACHE_MAX_MB
+from collections import OrderedDict
+
+import io
+import math
+import json
+import threading
+
+# Boxes are widened to this grid, so slightly different boxes of the same region share a crop
+BOX_GRID = 0.02
+
+
+def normalize_box(box: list[float]) -> tuple[float, float, float, float]:
+    """
+    Pad a box and widen it to the box grid.
+
+    Args:
+        box (list[float]): Left, top, right and bottom as fractions of the image size
+
+    Returns:
+        tuple[float, float, float, float]: The padded box, clipped to the image
+    """
+    # Rounded first, so float errors do not push an edge which is on the grid to the next step
+    left, top, right, bottom = (round(value / BOX_GRID, 6) for value in box)
+    padding = CROP_PADDING / BOX_GRID
+    return (
+        max(0.0, round(math.floor(left - padding) * BOX_GRID, 2)),
+        max(0.0, round(math.floor(top - padding) * BOX_GRID, 2)),
+        min(1.0, round(math.ceil(right + padding) * BOX_GRID, 2)),
+        min(1.0, round(math.ceil(bottom + padding) * BOX_GRID, 2)),
+    )
+
+
+def crop_region(img_path: str, box: tuple[float, float, float, float]) -> bytes:
+    """
+    Cut a region out of the original image and encode it like the preprocessed images.
+
+    Args:
+        img_path (str): Path to the original image file
+        box (tuple[float, float, float, float]): Left, top, right and bottom as fractions of the image size
+
+    Returns:
+        bytes: The encoded crop
+    """
+    with Image.open(img_path) as img:
+        # The box was located on the preprocessed image, which has the EXIF orientation applied
+        img = ImageOps.exif_transpose(img)
+        width, height = img.size
+        crop = img.crop((round(box[0] * width), round(box[1] * height), round(box[2] * width), round(box[3] * height)))
+        crop.thumbnail((PREPROCESS_MAX_DIMENSION, PREPROCESS_MAX_DIMENSION), Image.LANCZOS)
+        if PREPROCESS_FORMAT.upper() in ("JPEG", "JPG") and crop.mode != "RGB":
+            crop = crop.convert("RGB")
+
+        output = io.BytesIO()
+        crop.save(output, format=PREPROCESS_FORMAT, quality=PREPROCESS_QUALITY, optimize=True)
+        return output.getvalue()
+
+
+class CropCache:
+    """
+    A least recently used cache of image crops, keyed by the image content and the region.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        """
+        Initialize an empty cache.
+
+        Args:
+            max_entries (int): Maximum number of crops kept in memory
+            max_bytes (int): Maximum total size of the crops in bytes
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._crops = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get_crop(self, img_path: str, image_data: bytes | None, box: list[float]) -> bytes | None:
+        """
+        Return the crop of a region of an image, cutting it on first use.
+
+        Args:
+            img_path (str): Path to the original image file
+            image_data (bytes | None): The preprocessed image, identifies the image content
+            box (list[float]): The located region, left, top, right and bottom as fractions of the image size
+
+        Returns:
+            bytes | None: The encoded crop, or None if the region is too large to be worth cropping
+                          or the original image cannot be read
+        """
+        box = normalize_box(box)
+        if (box[2] - box[0]) * (box[3] - box[1]) > MAX_CROP_AREA:
+            return None
+
+        key = content_hash(image_data if image_data is not None else img_path, json.dumps(box))
+        with self._lock:
+            if key in self._crops:
+                self.hits += 1
+                self._crops.move_to_end(key)
+                return self._crops[key]
+            self.misses += 1
+
+        try:
+            crop = crop_region(img_path, box)
+        except OSError as e:
+            print(f"[WARNING] Could not crop {img_path}: {e}")
+            return None
+
+        with self._lock:
+            if key not in self._crops:
+                self._crops[key] = crop
+                self._bytes += len(crop)
+            while self._crops and (len(self._crops) > self.max_entries or self._bytes > self.max_bytes):
+                self._bytes -= len(self._crops.popitem(last=False)[1])
+        return crop
+
+
+crop_cache = CropCache(max_entries=CROP_CACHE_ENTRIES, max_bytes=CROP_CACHE_MAX_MB * 1024 * 1024)
@@ -0,0 +1,261 @@
+"""
+This module gives the agent tools access to the data of the run they belong to.
+
+The tools receive the run ID through the "configurable" section of their RunnableConfig and
+look up the run's RunContext here, so concurrent runs never see each other's images or features.
+The context also memoizes the tool results of the run and enforces its tool call budget.
+"""
+
+from contextlib import contextmanager
+from langchain_core.runnables import RunnableConfig
+from utils.state import ImageProcessingState
+from utils.index import ImageIndex
+from utils.model import LLM
+from utils.config import AGENT_MAX_TOOL_CALLS
+from utils.profiles import get_profile
+from utils.metrics import TOOL_MEMO_HITS
+from utils.cache import content_hash
+
+import os
+import shutil
+import tempfile
+import threading
+
+_runs = {}
+_lock = threading.Lock()
+
+
+class RunContext:
+    """
+    The data of a single run which is shared with the agent tools.
+    """
+
+    def __init__(self, state: ImageProcessingState):
+        """
+        Initialize the context from the state of the run.
+
+        Args:
+            state (ImageProcessingState): The state of the run
+        """
+        self.run_id = state["run_id"]
+        self.state = state
+        self.tool_calls = 0
+        self._index = None
+        self._tool_results = {}
+        self._lock = threading.Lock()
+
+    @property
+    def features(self) -> list[dict]:
+        return self.state["features"]
+
+    @property
+    def profile(self) -> dict:
+        return get_profile(self.state["profile"])
+
+    def get_index(self, llm: LLM) -> ImageIndex:
+        """
+        Return the embedding index of the run's image descriptions, building it on first use.
+
+        Args:
+            llm (LLM): Used to embed the descriptions
+
+        Returns:
+            ImageIndex: The index of the run
+        """
+        with self._lock:
+            if self._index is None:
+                self._index = ImageIndex.build(self.features, llm)
+            return self._index
+
+    def owns_image(self, img_path: str) -> bool:
+        """
+        Check whether an image belongs to this run.
+
+        Args:
+            img_path (str): Path of the image
+
+        Returns:
+            bool: True if the image was loaded by this run
+        """
+        return img_path in self.state["image_paths"]
+
+    def best_of_group(self, img_path: str) -> str:
+        """
+        Return the sharpest image of the group of near-duplicates an image belongs to.
+
+        Args:
+            img_path (str): Path of an image of this run
+
+        Returns:
+            str: Path of the best image of the group, img_path itself if it has no group
+        """
+        for best, group in self.state["image_groups"].items():
+            if img_path in group:
+                return best
+        return img_path
+
+    def image_data(self, img_path: str) -> bytes | None:
+        """
+        Return the preprocessed content of an image of this run.
+
+        Args:
+            img_path (str): Path of the image
+
+        Returns:
+            bytes | None: The preprocessed image, or None if it was not preprocessed
+        """
+        image_hash = self.state["image_hashes"].get(img_path)
+        return load_image_data(self.run_id, image_hash) if image_hash is not None else None
+
+    def call_tool(self, tool: str, key: str, compute):
+        """
+        Run a tool call once per run and key, and within the run's tool call budget.
+
+        Concurrent calls with the same key wait for the first one and share its result. Failed
+        calls are not memoized. Once AGENT_MAX_TOOL_CALLS calls were executed, new calls are not
+        run and return a message telling the agent to finish.
+
+        Args:
+            tool (str): Name of the tool
+            key (str): The normalized arguments of the call
+            compute (Callable[[], Any]): Executes the tool call
+
+        Returns:
+            The result of the tool call
+        """
+        with self._lock:
+            entry = self._tool_results.setdefault((tool, key), {"lock": threading.Lock()})
+
+        with entry["lock"]:
+            if "result" in entry:
+                TOOL_MEMO_HITS.labels(tool).inc()
+                print(f"[DEBUG] {tool} answered from the memo of run {self.run_id}")
+                return entry["result"]
+
+            with self._lock:
+                if self.tool_calls >= AGENT_MAX_TOOL_CALLS:
+                    return f"The tool call limit of {AGENT_MAX_TOOL_CALLS} calls is reached. Do not call tools anymore, give your final answer with the information you have."
+                self.tool_calls += 1
+
+            entry["result"] = compute()
+            return entry["result"]
+
+
+@contextmanager
+def run_scope(state: ImageProcessingState):
+    """
+    Make the run of the given state reachable for the tools while the context is active.
+
+    Args:
+        state (ImageProcessingState): The state of the run
+
+    Yields:
+        RunContext: The context of the run
+    """
+    run = RunContext(state)
+    with _lock:
+        _runs[run.run_id] = run
+    try:
+        yield run
+    finally:
+        with _lock:
+            _runs.pop(run.run_id, None)
+
+
+def get_run_context(config: RunnableConfig) -> RunContext:
+    """
+    Look up the run a tool call belongs to.
+
+    Args:
+        config (RunnableConfig): The config passed to the tool
+
+    Returns:
+        RunContext: The context of the run
+
+    Raises:
+        KeyError: If the config has no run ID or the run is not active
+    """
+    run_id = (config or {}).get("configurable", {}).get("run_id")
+    with _lock:
+        if run_id not in _runs:
+            raise KeyError(f"No active run with ID {run_id!r}")
+        return _runs[run_id]
+
+
+def workspace_path(run_id: str) -> str:
+    """
+    Return the path of a run's workspace directory, without creating it.
+
+    Args:
+        run_id (str): ID of the run
+
+    Returns:
+        str: Path of the run's directory
+    """
+    return os.path.join(os.getcwd(), "data", "runs", run_id)
+
+
+def get_workspace(run_id: str) -> str:
+    """
+    Return the directory where the preprocessed images and the debug files of a run are written, creating it if needed.
+
+    Args:
+        run_id (str): ID of the run
+
+    Returns:
+        str: Path of the run's directory
+    """
+    workspace = workspace_path(run_id)
+    os.makedirs(workspace, exist_ok=True)
+    return workspace
+
+
+def save_image_data(run_id: str, data: bytes) -> str:
+    """
+    Store a preprocessed image in the run's workspace.
+
+    The images are kept out of the graph state, so the checkpointer does not write a copy of
+    every image after each node. Only their content hashes are stored in the state.
+
+    Args:
+        run_id (str): ID of the run
+        data (bytes): The preprocessed image
+
+    Returns:
+        str: Content hash of the image, used to load it again
+    """
+    image_hash = content_hash(data)
+    images_dir = os.path.join(get_workspace(run_id), "images")
+    path = os.path.join(images_dir, image_hash)
+    if not os.path.exists(path):
+        os.makedirs(images_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=images_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return image_hash
+
+
+def load_image_data(run_id: str, image_hash: str) -> bytes:
+    """
+    Load a preprocessed image stored by save_image_data.
+
+    Args:
+        run_id (str): ID of the run
+        image_hash (str): Content hash of the image
+
+    Returns:
+        bytes: The preprocessed image
+    """
+    with open(os.path.join(workspace_path(run_id), "images", image_hash), "rb") as f:
+        return f.read()
+
+
+def delete_workspace(run_id: str) -> None:
+    """
+    Remove the workspace of a run which will not be resumed, with its preprocessed images and debug files.
+
+    Args:
+        run_id (str): ID of the run
+    """
+    shutil.rmtree(workspace_path(run_id), ignore_errors=True)
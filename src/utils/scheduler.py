@@ -0,0 +1,257 @@
+"""
+This module contains the scheduler every OpenAI request of the LLM class goes through.
+
+Requests are admitted per model by two token buckets, one for requests per minute and one for
+tokens per minute, using an estimate of the request's tokens which is corrected with the real
+usage afterwards. Waiting requests are served by priority, so interactive jobs run ahead of batch
+jobs. Rate limit errors, server errors and connection errors are retried with jittered
+exponential backoff.
+"""
+
+from contextlib import contextmanager
+from utils.config import env_int, env_float
+from utils.metrics import LLM_QUEUE_SECONDS, LLM_REQUEST_SECONDS, LLM_RETRIES, record_usage
+
+import os
+import json
+import time
+import heapq
+import random
+import itertools
+import threading
+import contextvars
+import openai
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+# Rough number of input tokens of an image after preprocessing
+IMAGE_TOKENS = 1000
+# Expected number of output tokens of a request, reserved up front
+OUTPUT_TOKENS = 1000
+# About 4 characters per token for English text
+CHARS_PER_TOKEN = 4
+
+_priority = contextvars.ContextVar("llm_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def llm_priority(priority: int):
+    """
+    Set the priority of the LLM requests made in this context.
+
+    The priority is stored in a context variable, thread pools have to copy the context
+    (e.g. langchain's ContextThreadPoolExecutor) to pass it on.
+
+    Args:
+        priority (int): PRIORITY_INTERACTIVE or PRIORITY_BATCH
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def text_tokens(*texts: str) -> int:
+    """
+    Estimate the tokens of texts, without the images and the output of a request.
+
+    Args:
+        *texts (str): The texts
+
+    Returns:
+        int: Estimated number of tokens
+    """
+    return sum(len(text) for text in texts if text) // CHARS_PER_TOKEN
+
+
+def estimate_tokens(*texts: str, images: int = 0) -> int:
+    """
+    Estimate the tokens of a request before sending it.
+
+    Args:
+        *texts (str): The texts of the request
+        images (int, optional): Number of images in the request. Defaults to 0
+
+    Returns:
+        int: Estimated input and output tokens
+    """
+    return text_tokens(*texts) + images * IMAGE_TOKENS + OUTPUT_TOKENS
+
+
+class TokenBucket:
+    """
+    A token bucket which refills continuously up to its capacity.
+    """
+
+    def __init__(self, capacity: float, per_minute: float):
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Return the number of seconds until amount can be taken, 0 if it can be taken now.
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        """
+        Take amount from the bucket. A negative amount returns it, the level may go below zero.
+        """
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+class _ModelQueue:
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute)
+        self.waiters = []
+
+
+class Scheduler:
+    """
+    Admits requests per model within their rate limits, by priority, and retries failed requests.
+    """
+
+    def __init__(self, limits: dict, default_limits: tuple[int, int], max_retries: int, base_delay: float, max_delay: float):
+        """
+        Initialize the scheduler.
+
+        Args:
+            limits (dict): Requests and tokens per minute by model name, e.g. {"gpt-4.1-mini": [500, 200000]}
+            default_limits (tuple[int, int]): Requests and tokens per minute of the models not in limits
+            max_retries (int): Maximum number of retries of a request
+            base_delay (float): Backoff delay before the first retry, in seconds
+            max_delay (float): Upper limit of the backoff delay, in seconds
+        """
+        self.limits = limits
+        self.default_limits = default_limits
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._queues = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def _queue(self, model: str) -> _ModelQueue:
+        if model not in self._queues:
+            self._queues[model] = _ModelQueue(*self.limits.get(model, self.default_limits))
+        return self._queues[model]
+
+    def acquire(self, model: str, tokens: int, priority: int) -> float:
+        """
+        Wait until a request fits the rate limits of the model and no request with a higher priority is waiting.
+
+        Args:
+            model (str): The model of the request
+            tokens (int): Estimated tokens of the request
+            priority (int): Priority of the request, lower runs first
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        start = time.monotonic()
+        with self._condition:
+            queue = self._queue(model)
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(queue.waiters, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if queue.waiters[0] == ticket:
+                        timeout = max(queue.requests.wait_time(1), queue.tokens.wait_time(tokens))
+                        if timeout <= 0:
+                            queue.requests.take(1)
+                            queue.tokens.take(tokens)
+                            return time.monotonic() - start
+                    self._condition.wait(timeout=timeout)
+            finally:
+                queue.waiters.remove(ticket)
+                heapq.heapify(queue.waiters)
+                self._condition.notify_all()
+
+    def correct(self, model: str, estimated_tokens: int, used_tokens: int | None) -> None:
+        """
+        Correct the token bucket of a model with the real usage of a request.
+
+        Args:
+            model (str): The model of the request
+            estimated_tokens (int): Tokens taken when the request was admitted
+            used_tokens (int | None): Tokens reported by the API, None if unknown
+        """
+        if used_tokens is None:
+            return
+        with self._condition:
+            self._queue(model).tokens.take(used_tokens - estimated_tokens)
+            self._condition.notify_all()
+
+    def run(self, model: str, estimated_tokens: int, request, operation: str = "request"):
+        """
+        Send a request within the rate limits of its model, retrying it on transient errors.
+
+        The queue wait, the duration, the token usage and the cost of the request are recorded
+        in the metrics.
+
+        Args:
+            model (str): The model of the request
+            estimated_tokens (int): Estimated tokens of the request, see estimate_tokens()
+            request (Callable[[], Any]): Sends the request and returns the response
+            operation (str, optional): Name of the operation for the metrics. Defaults to "request"
+
+        Returns:
+            The response of the request
+        """
+        priority = _priority.get()
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.max_retries + 1):
+                LLM_QUEUE_SECONDS.labels(model).observe(self.acquire(model, estimated_tokens, priority))
+                try:
+                    response = request()
+                except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self._backoff(attempt, e)
+                    LLM_RETRIES.labels(model).inc()
+                    print(f"[WARNING] {model} request failed ({type(e).__name__}), retrying in {delay:.1f} s")
+                    time.sleep(delay)
+                    continue
+
+                usage = getattr(response, "usage", None)
+                self.correct(model, estimated_tokens, getattr(usage, "total_tokens", None))
+                record_usage(operation, model, usage)
+                return response
+        finally:
+            LLM_REQUEST_SECONDS.labels(operation, model).observe(time.perf_counter() - start)
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        # Respect the server's Retry-After header if it is longer than the backoff
+        retry_after = 0.0
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after", 0))
+            except (TypeError, ValueError):
+                retry_after = 0.0
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return max(retry_after, random.uniform(delay / 2, delay))
+
+
+scheduler = Scheduler(
+    limits=json.loads(os.getenv("LLM_RATE_LIMITS", "{}")),
+    default_limits=(env_int("LLM_DEFAULT_RPM", 500), env_int("LLM_DEFAULT_TPM", 200000)),
+    max_retries=env_int("LLM_MAX_RETRIES", 6),
+    base_delay=env_float("LLM_BACKOFF_BASE", 1.0),
+    max_delay=env_float("LLM_BACKOFF_MAX", 60.0),
+)
@@ -7,12 +7,17 @@ from typing import TypedDict
 from pydantic import BaseModel, Field
 
 class ImageProcessingState(TypedDict):
+    run_id: str
+    case_id: str | None
+    profile: str
     images_dir: str
-    images: list[str]
     image_names: list[str]
     image_paths: list[str]
+    image_hashes: dict[str, str]
+    image_groups: dict[str, list[str]]
     features: list[str]
     aggregated_info: str
+    missing_fields: list[str]
     final_report_markdown: str
     messages: list
 
@@ -1,14 +1,22 @@
 from langchain.tools import tool
 from utils.model import LLM
+from utils.files import file_registry
 from typing import List, Dict
 from langchain.tools import tool
 from langchain_community.tools import DuckDuckGoSearchRun
+from langchain_core.runnables import RunnableConfig
+from utils.run_context import RunContext, get_run_context
+from utils.config import INDEX_TOP_K, INDEX_RERANK, ANALYZE_CONCURRENCY, ANALYZE_CONFIDENCE_THRESHOLD, FIND_MODE, SEARCH_MODE
+from utils.cache import content_hash, search_cache
+from utils.metrics import TOOL_CALLS
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from concurrent.futures import as_completed
 
-import yaml
-import os
+import re
+import json
 
 @tool(parse_docstring=True)
-def select_relevant_images(missing_info_summary: str) -> List[str]:
+def select_relevant_images(missing_info_summary: str, config: RunnableConfig) -> List[str]:
     """
     A tool to select relevant images based on their descriptions and a summary of missing information in the report.
 
@@ -18,14 +26,24 @@ def select_relevant_images(missing_info_summary: str) -> List[str]:
     Returns:
         List[str]: A list of image paths that likely contain the missing information.
     """
+    TOOL_CALLS.labels("select_relevant_images").inc()
+    run = get_run_context(config)
+    return run.call_tool("select_relevant_images", normalize_text(missing_info_summary), lambda: _select_relevant_images(run, missing_info_summary))
+
+
+def _select_relevant_images(run: RunContext, missing_info_summary: str) -> List[str]:
     llm = LLM()
 
-    data_dir = os.path.join(os.getcwd(), "data", "runs")
-    os.makedirs(data_dir, exist_ok=True)
-    features_path = os.path.join(data_dir, "features.yaml")
-    with open(features_path, "r") as f:
-        features: List[Dict[str, str]] = yaml.safe_load(f)
-        descriptions_formatted = "\n\n".join(feature["image_path"] + ":\n" + feature["extracted_text"] for feature in features)
+    # The embedding index of the run is built on the first call and answers locally
+    candidates = run.get_index(llm).search(missing_info_summary, INDEX_TOP_K * 2 if INDEX_RERANK else INDEX_TOP_K)
+    print(f"[DEBUG] Candidates of select_relevant_images with missing_info_summary: {missing_info_summary}\n{candidates}")
+
+    if not INDEX_RERANK or len(candidates) <= INDEX_TOP_K:
+        return [image_path for image_path, _ in candidates]
+
+    candidate_paths = {image_path for image_path, _ in candidates}
+    features: List[Dict[str, str]] = [feature for feature in run.features if feature["image_path"] in candidate_paths]
+    descriptions_formatted = "\n\n".join(feature["image_path"] + ":\n" + feature["extracted_text"] for feature in features)
 
     system_prompt = (
         "You are a helpful assistant. Based on the missing information in a report, identify which image descriptions are likely to contain relevant data. Return ONLY a JSON list of image paths that should be examined further."
@@ -37,21 +55,21 @@ def select_relevant_images(missing_info_summary: str) -> List[str]:
 
         Image descriptions:\n{descriptions_formatted}
 
-        Return a JSON list of image paths.
+        Return a JSON list of at most {INDEX_TOP_K} image paths.
         """
     )
 
-    result = llm.invoke(user_prompt, system_prompt)
+    result = llm.invoke(user_prompt, system_prompt, model=run.profile["tool_model"])
     print(f"[DEBUG] Result of select_relevant_images with missing_info_summary: {missing_info_summary}\n{result}")
     try:
-        import json
         return json.loads(result)
     except Exception:
-        return result
+        # Fall back to the order of the index
+        return [image_path for image_path, _ in candidates[:INDEX_TOP_K]]
 
 
 @tool(parse_docstring=True)
-def analyze_images(image_paths: List[str], information: str) -> str:
+def analyze_images(image_paths: List[str], information: str, config: RunnableConfig) -> str:
     """
     Analyzes a list of image files to extract missing information from them.
 
@@ -67,24 +85,77 @@ def analyze_images(image_paths: List[str], information: str) -> str:
         information = "Model of the car."
     """
 
+    TOOL_CALLS.labels("analyze_images").inc()
+    run = get_run_context(config)
+    # The order of the paths does not change the answer
+    key = json.dumps([sorted(path.strip() for path in image_paths), normalize_text(information)])
+    return run.call_tool("analyze_images", key, lambda: _analyze_images(run, image_paths, information))
+
+
+def _analyze_images(run: RunContext, image_paths: List[str], information: str) -> str:
     llm = LLM()
 
-    aggregated_information = ""
-    for path in image_paths:
-        response = llm.find_information(path, information, aggregated_information)
-        aggregated_information += f"\n{response}"
+    # Only the images of this run may be opened
+    responses = {path: f"{path} is not an image of this report." for path in image_paths if not run.owns_image(path)}
+    # Near-duplicates of one group are answered by the sharpest image of the group
+    owned_paths = list(dict.fromkeys(run.best_of_group(path) for path in image_paths if path not in responses))
+
+    # Every image is looked at independently, the answers are only combined in the reduce step below
+    executor = ContextThreadPoolExecutor(max_workers=max(1, min(ANALYZE_CONCURRENCY, len(owned_paths))))
+    futures = {
+        executor.submit(llm.find_information, path, information, "", model=run.profile["find_model"], image_data=run.image_data(path), two_pass=FIND_MODE == "two_pass"): path
+        for path in owned_paths
+    }
+    try:
+        for future in as_completed(futures):
+            response = future.result()
+            responses[futures[future]] = response
+            if parse_confidence(response) >= ANALYZE_CONFIDENCE_THRESHOLD:
+                print(f"[DEBUG] {futures[future]} answered '{information}' with enough confidence, skipping the remaining images")
+                break
+    finally:
+        # Lookups which have not started yet are dropped, running ones finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    aggregated_information = "\n".join(f"{path}:\n{responses[path]}" for path in dict.fromkeys(image_paths + owned_paths) if path in responses)
 
     system_prompt = "You are a helpful assistant who receives descriptions from images which contain missing information from a report."
 
     user_prompt = f"Give answers to the missing information based on the image descriptions.\n\nMissing information:\n{information}\n\nImage descriptions:\n{aggregated_information}"
 
 
-    result = llm.invoke(user_prompt, system_prompt)
+    result = llm.invoke(user_prompt, system_prompt, model=run.profile["tool_model"])
     print(f"[DEBUG] Result of analyze_images for information '{information}': {result}")
+    print(f"[DEBUG] Uploads: {file_registry.stats()}")
     return result
 
+def parse_confidence(response: str) -> float:
+    """
+    Read the "Confidence: <0-1>" line at the end of a find_information answer.
+
+    Args:
+        response (str): The answer of find_information
+
+    Returns:
+        float: The stated confidence, 0 if there is none
+    """
+    matches = re.findall(r"confidence\W*([01](?:\.\d+)?)", response, re.IGNORECASE)
+    return float(matches[-1]) if matches else 0.0
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a tool argument for the memo: lowercase with single spaces.
+
+    Args:
+        text (str): The argument
+
+    Returns:
+        str: The normalized argument
+    """
+    return " ".join(text.lower().split())
+
 @tool(parse_docstring=True)
-def ddg_search(query: str) -> str:
+def ddg_search(query: str, config: RunnableConfig) -> str:
     """
     Searches the DuckDuckGo search engine for the query. Useful for looking for information on the internet.
     
@@ -94,10 +165,31 @@ def ddg_search(query: str) -> str:
     Returns:
         A string containing the search results.
     """
+    TOOL_CALLS.labels("ddg_search").inc()
+    run = get_run_context(config)
+    return run.call_tool("ddg_search", normalize_text(query), lambda: _ddg_search(query))
+
+
+def _ddg_search(query: str) -> str:
+    if SEARCH_MODE == "offline":
+        return "The web search is not available, use the images to find the information."
+
+    # The results are shared by all runs and workers, the same specifications are searched often
+    key = content_hash("ddg_search", normalize_text(query))
+    result = search_cache.get(key)
+    if result is not None:
+        print(f"[DEBUG] Cached result of ddg_search for query '{query}': {result}")
+        return result
+
+    if SEARCH_MODE == "cache_only":
+        return f"No search results are available for '{query}'."
+
     search = DuckDuckGoSearchRun()
     result = search.invoke(query)
 
     print(f"[DEBUG] Result of ddg_search for query '{query}': {result}")
+    if result:
+        search_cache.set(key, result)
 
     return result
 